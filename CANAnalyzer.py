@@ -60,9 +60,10 @@ class CANAnalyzerPanel(wx.Panel):
         self.can = None
             
     def OnStart(self, event):
-        self.can = CANController.CANUSBController(self.serialPort.GetStringSelection(), int(self.speed.GetStringSelection()))
+        self.can = CANController.CANUSBController(self.serialPort.GetStringSelection(), int(self.speed.GetStringSelection()),
+                                                  config.getboolean("CANUSB", "HardwareTimestamps"))
                 
-        self.can.Start(self.RxCallback)
+        self.can.Start(self.RxCallback, config.getboolean("CANUSB", "AcquisitionProcess"))
         
         self.RxPanel.Start(self.can)
         self.TxPanel.Start(self.can)
@@ -127,6 +128,10 @@ if __name__ == "__main__":
         config.set("CANUSB", "serialPort", serialports[0])
     if not config.has_option("CANUSB", "CANBitsPerSec"):
         config.set("CANUSB", "CANBitsPerSec", CANBitsPerSec[0])
+    if not config.has_option("CANUSB", "HardwareTimestamps"):
+        config.set("CANUSB", "HardwareTimestamps", "0")
+    if not config.has_option("CANUSB", "AcquisitionProcess"):
+        config.set("CANUSB", "AcquisitionProcess", "0")
         
     app = CANAnalyzerApp(0)     
     app.MainLoop()
@@ -0,0 +1,182 @@
+'''
+Batch signal decoding
+
+Decodes a signal from many frames at once with numpy, e.g. to plot or
+export it from a whole capture. Payloads are (N, 8) uint8 arrays; the
+signal bits are extracted from all of them with the shift and mask of
+the signal's SignalCodec, then reinterpreted as the signal type, giving
+the same values as CANSignal.from_canframe().
+
+numpy is only needed by this module, the rest of the analyzer runs
+without it.
+
+    reader = CANLog.CaptureReader("bus.cap")
+    series = decode_capture(signal, reader)
+    plot(series['time'], series['value'])
+'''
+import CANLog
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("numpy is needed for batch decoding")
+
+
+if numpy is not None:
+    # a CANLog record
+    RECORD_DTYPE = numpy.dtype([('timestamp', '<f8'), ('msg_id', '<u4'), ('flags', 'u1'),
+                                ('dlc', 'u1'), ('data', 'u1', (8,)), ('pad', 'V2')])
+    assert RECORD_DTYPE.itemsize == CANLog.RECORD.size
+
+    # dataType -> (dtype of the intel value, of the motorola value), the
+    # value being stored in the first bytes of the shifted payload as
+    # in CANMessage.SIGNAL_FORMATS
+    VALUE_DTYPES = {
+        "u8":  ('u1', 'u1'),
+        "i8":  ('i1', 'i1'),
+        "u16": ('<u2', '>u2'),
+        "i16": ('<i2', '>i2'),
+        "u32": ('<u4', '>u4'),
+        "i32": ('<i4', '>i4'),
+        "u64": ('<u8', '>u8'),
+        "i64": ('<i8', '>i8'),
+        "f32": ('<f4', '>f4'),
+        "f64": ('<f8', '>f8'),
+    }
+
+
+def series_dtype(signal):
+    """dtype of the time series of a signal: time and value fields"""
+    _require_numpy()
+    dataType = signal.get_codec().dataType
+    if dataType == "bit":
+        value = numpy.uint8
+    else:
+        value = numpy.dtype(VALUE_DTYPES[dataType][0]).newbyteorder('=')
+    return numpy.dtype([('time', numpy.float64), ('value', value)])
+
+
+def decode_payloads(codec, payloads):
+    """Values of the signal of a SignalCodec in an (N, 8) uint8 array of
+    payloads, as an array of N values
+    """
+    _require_numpy()
+    payloads = numpy.ascontiguousarray(payloads, dtype=numpy.uint8).reshape(-1, 8)
+    count = len(payloads)
+    # read as native 64 bit integers like CANMessage.PAYLOAD
+    raw = payloads.view(numpy.uint64).reshape(count)
+    mask = codec.mask & 0xFFFFFFFFFFFFFFFFL
+    shift = codec.shift
+    if not mask:
+        tmp = numpy.zeros(count, numpy.uint64)
+    elif shift < 0:
+        tmp = (raw & numpy.uint64(mask)) << numpy.uint64(-shift)
+    else:
+        tmp = (raw & numpy.uint64(mask)) >> numpy.uint64(shift)
+
+    if codec.dataType == "bit":
+        return (tmp > 0).view(numpy.uint8)
+    if codec.endian == "motorola":
+        dtype = numpy.dtype(VALUE_DTYPES[codec.dataType][1])
+    else:
+        dtype = numpy.dtype(VALUE_DTYPES[codec.dataType][0])
+    values = tmp.view(numpy.uint8).reshape(count, 8)[:, :dtype.itemsize]
+    values = numpy.ascontiguousarray(values).view(dtype).reshape(count)
+    return values.astype(dtype.newbyteorder('='))
+
+
+def decode_signal(signal, payloads, timestamps):
+    """Time series of a CANSignal: structured array of the timestamps and
+    the values decoded from an (N, 8) uint8 array of payloads
+    """
+    _require_numpy()
+    values = decode_payloads(signal.get_codec(), payloads)
+    series = numpy.empty(len(values), series_dtype(signal))
+    series['time'] = timestamps
+    series['value'] = values
+    return series
+
+
+def frame_records(frames):
+    """Array of RECORD_DTYPE records of a list of CANFrames, e.g. frames
+    taken from a CANUSBController
+    """
+    _require_numpy()
+    if not frames:
+        return numpy.empty(0, RECORD_DTYPE)
+    return numpy.frombuffer(CANLog.pack_frames(frames), RECORD_DTYPE)
+
+
+def capture_records(reader, start=0, stop=None):
+    """Array of RECORD_DTYPE records of a CANLog.CaptureReader, mapping
+    the file rather than copying it, so only valid until the reader is
+    closed
+    """
+    _require_numpy()
+    buf, offset, count = reader.GetRecords()
+    if not count:
+        return numpy.empty(0, RECORD_DTYPE)
+    records = numpy.frombuffer(buf, RECORD_DTYPE, count, offset)
+    return records[start:stop]
+
+
+def select_id(records, msg_id, xtd=0):
+    """Records of the data frames with the given ID"""
+    _require_numpy()
+    flags = records['flags']
+    if xtd:
+        xtd = CANLog.FLAG_XTD
+    selected = (records['msg_id'] == msg_id) & ((flags & (CANLog.FLAG_XTD | CANLog.FLAG_RTR)) == xtd)
+    return records[selected]
+
+
+def decode_records(signal, records):
+    """Time series of a CANSignal in the frames of its ID among records"""
+    records = select_id(records, signal.get_id(), signal.get_xtd())
+    return decode_signal(signal, records['data'], records['timestamp'])
+
+
+def decode_capture(signal, reader, start=0, stop=None):
+    """Time series of a CANSignal in the frames start to stop of a
+    CANLog.CaptureReader, found with the ID index of the capture
+    """
+    _require_numpy()
+    records = capture_records(reader)
+    indexes = reader.GetFramesOfID(signal.get_id(), signal.get_xtd())
+    if not indexes:
+        return numpy.empty(0, series_dtype(signal))
+    indexes = numpy.frombuffer(indexes, numpy.uint32)
+    if stop is None:
+        stop = len(records)
+    indexes = indexes[indexes.searchsorted(start):indexes.searchsorted(stop)]
+    records = records[indexes]
+    records = records[(records['flags'] & CANLog.FLAG_RTR) == 0]
+    return decode_signal(signal, records['data'], records['timestamp'])
+
+
+def decode_message(message, records):
+    """Time series of every signal of a CANMessage.CANMessageDef in the
+    frames of its ID among records, as {signal name: series}. Multiplexed
+    signals only get the frames where the multiplexor selects them.
+    """
+    _require_numpy()
+    records = select_id(records, message.get_id(), message.get_xtd())
+    payloads = numpy.ascontiguousarray(records['data'])
+    timestamps = records['timestamp']
+    multiplexor = message.get_multiplexor()
+    if multiplexor is not None:
+        muxValues = decode_payloads(multiplexor.get_codec(), payloads)
+    series = {}
+    for sig in message.get_signals():
+        mux = sig.get_mux()
+        if mux is None or sig is multiplexor:
+            series[sig.get_name()] = decode_signal(sig, payloads, timestamps)
+        elif multiplexor is not None:
+            selected = muxValues == mux
+            series[sig.get_name()] = decode_signal(sig, payloads[selected], timestamps[selected])
+    return series
@@ -0,0 +1,209 @@
+'''
+Bus load measurement
+
+frame_bits() returns the exact number of bits a frame occupies on the
+wire, including the stuff bits and the interframe space. The CRC is
+computed a byte at a time from a table and the stuff bits are counted a
+byte at a time from a state table, the first bits of the frame being
+handled one by one to align the rest on bytes.
+'''
+import threading
+
+CRC15_POLY = 0x4599
+
+# Bits after the CRC, never stuffed: CRC delimiter, ACK slot, ACK
+# delimiter, end of frame and intermission
+TRAILER_BITS = 1 + 1 + 1 + 7 + 3
+
+
+def _crc15_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 7
+        for i in range(8):
+            crc = crc << 1
+            if crc & 0x8000:
+                crc = crc ^ CRC15_POLY
+        table.append(crc & 0x7fff)
+    return table
+
+CRC15_TABLE = _crc15_table()
+
+
+def crc15(value, nbits):
+    """CRC of the nbits bits of value, most significant bit first"""
+    # leading zero bits leave a zero CRC unchanged, pad to whole bytes
+    nbytes = (nbits + 7) // 8
+    crc = 0
+    table = CRC15_TABLE
+    for shift in range(8 * (nbytes - 1), -8, -8):
+        crc = ((crc << 8) & 0x7fff) ^ table[((crc >> 7) ^ (value >> shift)) & 0xff]
+    return crc
+
+
+def _stuff(value, nbits, bit, run):
+    """Count the stuff bits of nbits bits of value, most significant bit
+    first, after a run of run bits equal to bit. Returns (stuff bits, last
+    bit, run length) with stuff bits counted in the runs.
+    """
+    stuffed = 0
+    for shift in range(nbits - 1, -1, -1):
+        b = (value >> shift) & 1
+        if b == bit:
+            run = run + 1
+        else:
+            bit = b
+            run = 1
+        if run == 5:
+            stuffed = stuffed + 1
+            bit = bit ^ 1
+            run = 1
+    return stuffed, bit, run
+
+
+def _stuff_table():
+    # state = bit * 5 + run - 1, with run from 1 to 4 after stuffing
+    table = []
+    for state in range(10):
+        bit, run = divmod(state, 5)
+        row = []
+        for byte in range(256):
+            stuffed, b, r = _stuff(byte, 8, bit, run + 1)
+            row.append((stuffed, b * 5 + r - 1))
+        table.append(row)
+    return table
+
+STUFF_TABLE = _stuff_table()
+
+
+def frame_bits(msg_id, xtd, rtr, ndata, data):
+    """Number of bits of a classic CAN frame on the wire"""
+    if xtd:
+        # SOF, base ID, SRR, IDE, extended ID, RTR, r1, r0, DLC
+        value = (((((msg_id >> 18) & 0x7ff) << 2 | 3) << 18 | (msg_id & 0x3ffff)) << 3 | rtr << 2) << 4 | ndata
+        nbits = 1 + 11 + 1 + 1 + 18 + 1 + 1 + 1 + 4
+    else:
+        # SOF, ID, RTR, IDE, r0, DLC
+        value = ((msg_id & 0x7ff) << 3 | rtr << 2) << 4 | ndata
+        nbits = 1 + 11 + 1 + 1 + 1 + 4
+    if not rtr:
+        for byte in data[:ndata]:
+            value = value << 8 | byte
+        nbits = nbits + 8 * min(ndata, 8)
+    value = value << 15 | crc15(value, nbits)
+    nbits = nbits + 15
+
+    # the unaligned head bit by bit, starting with SOF, the rest by bytes
+    head = nbits % 8 or 8
+    stuffed, bit, run = _stuff(value >> (nbits - head), head, 1, 0)
+    state = bit * 5 + run - 1
+    table = STUFF_TABLE
+    for shift in range(nbits - head - 8, -8, -8):
+        n, state = table[state][(value >> shift) & 0xff]
+        stuffed = stuffed + n
+    return nbits + stuffed + TRAILER_BITS
+
+
+class BusLoadMeter(object):
+    """Share of the bus bandwidth used by the frames seen.
+
+    Frames are counted in windows of WINDOW seconds by timestamp. The
+    load is interpolated between the last complete window and the
+    current one, like a sliding window, and the peak is the highest load
+    of a complete window. Frame lengths are cached per header and
+    payload, as most traffic repeats.
+    """
+    WINDOW = 1.0
+    CACHE_SIZE = 4096
+
+    def __init__(self, bitrate):
+        self.bitrate = bitrate
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.__reset()
+
+    def clear(self):
+        self._lock.acquire()
+        self.__reset()
+        self._lock.release()
+
+    def __reset(self):
+        self._windowStart = None
+        self._bits = 0            # bits in the current window
+        self._prevBits = 0        # bits in the previous window
+        self._idBits = {}         # (msg_id, xtd) -> bits in the current window
+        self._prevIdBits = {}
+        self.peak = 0.0
+        self.totalBits = 0
+
+    def add(self, frames, timestamp=None):
+        """Count frames, at their own timestamps or at the given one"""
+        if not frames:
+            return
+        cache = self._cache
+        self._lock.acquire()
+        for f in frames:
+            key = (f.msg_id, f.xtd, f.rtr, f.ndata, f.data)
+            bits = cache.get(key)
+            if bits is None:
+                if len(cache) >= self.CACHE_SIZE:
+                    cache.clear()
+                bits = cache[key] = frame_bits(f.msg_id, f.xtd, f.rtr, f.ndata, f.data)
+            if timestamp is None:
+                self.__roll(f.timestamp)
+            else:
+                self.__roll(timestamp)
+            self._bits = self._bits + bits
+            idKey = (f.msg_id, f.xtd)
+            self._idBits[idKey] = self._idBits.get(idKey, 0) + bits
+            self.totalBits = self.totalBits + bits
+        self._lock.release()
+
+    def __roll(self, ts):
+        if self._windowStart is None:
+            self._windowStart = ts
+            return
+        elapsed = ts - self._windowStart
+        if elapsed < self.WINDOW:
+            return
+        load = self._bits / (self.bitrate * self.WINDOW)
+        if load > self.peak:
+            self.peak = load
+        if elapsed >= 2 * self.WINDOW:
+            self._prevBits = 0
+            self._prevIdBits = {}
+        else:
+            self._prevBits = self._bits
+            self._prevIdBits = self._idBits
+        self._bits = 0
+        self._idBits = {}
+        self._windowStart = ts - elapsed % self.WINDOW
+
+    def get_load(self, now):
+        """Return (load, peak load, {(msg_id, xtd): load}), loads as
+        fractions of the bus bandwidth over the last WINDOW seconds
+        """
+        self._lock.acquire()
+        window = self.WINDOW
+        capacity = self.bitrate * window
+        if self._windowStart is None:
+            elapsed = 2 * window
+        else:
+            elapsed = now - self._windowStart
+        if elapsed >= 2 * window:
+            weights = ((self._bits, self._idBits, 0.0), )
+        elif elapsed >= window:
+            # the current window has ended without a frame
+            weights = ((self._bits, self._idBits, 2.0 - elapsed / window), )
+        else:
+            weights = ((self._prevBits, self._prevIdBits, 1.0 - elapsed / window),
+                       (self._bits, self._idBits, 1.0))
+        load = 0.0
+        idLoads = {}
+        for bits, idBits, weight in weights:
+            load = load + bits * weight / capacity
+            for key, n in idBits.items():
+                idLoads[key] = idLoads.get(key, 0.0) + n * weight / capacity
+        peak = self.peak
+        self._lock.release()
+        return load, max(peak, load), idLoads
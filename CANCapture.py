@@ -0,0 +1,230 @@
+'''
+Headless capture
+
+Records the traffic seen by a CANUSB dongle without any GUI, to a
+binary capture file (see CANLog) or as one line of text per frame:
+
+    <timestamp> <id>#<data>     e.g. 1256128800.123456 123#0102030405060708
+
+with 3 hex digits for standard IDs, 8 for extended ones and R instead
+of the data for remote frames. Throughput and loss counters are printed
+to stderr every few seconds.
+
+Usage: python CANCapture.py -p <port> [options], see usage().
+'''
+import sys
+import time
+import getopt
+import CANController
+import CANFilter
+import lawicel_canusb
+import CANServer
+
+# Frames kept in memory, the capture goes to the output
+STORE_CAPACITY = 10000
+
+# Frames waiting for the text output before the oldest are dropped
+QUEUE_LEN = 1000000
+
+
+def usage():
+    print >> sys.stderr, """%s -p <port> [options]
+-h, --help            Print help
+-p, --port=dev        Serial port of the CANUSB
+-b, --bitrate=n       CAN bitrate (default 500000)
+--std-ids=id,...      Only capture these standard IDs, in hex
+--ext-ids=id,...      Only capture these extended IDs, in hex
+-f, --filter=expr     Only capture the frames matching a filter
+                      expression, see CANFilter
+-o, --output=file     Binary capture file, - to print frames as text
+                      (default -)
+--text                Write frames as text to the output file
+--max-size=n          Start a new capture file every n MB
+--max-time=s          Start a new capture file every s seconds
+-d, --duration=s      Stop after s seconds (default: at Ctrl-C)
+-t, --timestamps      Use the dongle timestamps
+--process             Read the dongle in a separate process
+-s, --stats=s         Print counters every s seconds, 0 for never
+                      (default 5)
+--serve=port          Also stream the frames to TCP clients on the
+                      local port, see CANServer
+""" % (sys.argv[0],)
+
+
+def format_frame(f):
+    if f.xtd:
+        line = "%.6f %08X#" % (f.timestamp, f.msg_id)
+    else:
+        line = "%.6f %03X#" % (f.timestamp, f.msg_id)
+    if f.rtr:
+        return line + "R\n"
+    return line + "".join(["%02X" % b for b in f.data]) + "\n"
+
+
+# stats -- snapshot of c.GetStats(), taken here if None
+def print_stats(c, subscription, start, lastCount, lastTime, stats=None):
+    now = time.time()
+    count = c.GetTotalFrameCount()
+    if stats is None:
+        stats = c.GetStats()
+    stats = stats or {}
+    load, peak, idLoads = c.GetBusLoad()
+    line = "%.0fs: %d frames, %.0f frames/s, bus load %.1f%% (peak %.1f%%), parser dropped %d, filtered %d" % \
+           (now - start, count, (count - lastCount) / max(now - lastTime, 1e-6), load * 100, peak * 100,
+            stats.get('parser_dropped', 0), stats.get('frames_filtered', 0))
+    if 'ring_lost' in stats:
+        line = line + ", ring lost %d" % stats['ring_lost']
+    recording = c.GetRecordingStats()
+    if recording:
+        files, records, dropped, error = recording
+        line = line + ", recorded %d, dropped %d" % (records, dropped)
+        if error:
+            line = line + ", recording failed: %s" % error
+    if subscription:
+        line = line + ", output lost %d" % subscription.lost
+    print >> sys.stderr, line
+    return count, now
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hp:b:f:o:d:ts:v",
+                                   ["help", "port=", "bitrate=", "std-ids=", "ext-ids=", "filter=", "output=",
+                                    "text", "max-size=", "max-time=", "duration=", "timestamps", "process",
+                                    "stats=", "serve=", "verbose"])
+    except getopt.error, why:
+        print >> sys.stderr, why
+        return 1
+
+    port = None
+    bitrate = 500000
+    stdIDs = []
+    extIDs = []
+    expression = None
+    output = "-"
+    text = False
+    maxBytes = 0
+    maxSeconds = 0
+    duration = 0.0
+    timestamps = False
+    process = False
+    statsInterval = 5.0
+    servePort = None
+    verbose = False
+    try:
+        for o, a in opts:
+            if o in ('-h', '--help'):
+                usage()
+                return 0
+            elif o in ('-p', '--port'):
+                port = a
+            elif o in ('-b', '--bitrate'):
+                bitrate = int(a)
+            elif o == '--std-ids':
+                stdIDs = [int(i, 16) for i in a.split(',')]
+            elif o == '--ext-ids':
+                extIDs = [int(i, 16) for i in a.split(',')]
+            elif o in ('-f', '--filter'):
+                expression = a
+            elif o in ('-o', '--output'):
+                output = a
+            elif o == '--text':
+                text = True
+            elif o == '--max-size':
+                maxBytes = int(float(a) * 1024 * 1024)
+            elif o == '--max-time':
+                maxSeconds = float(a)
+            elif o in ('-d', '--duration'):
+                duration = float(a)
+            elif o in ('-t', '--timestamps'):
+                timestamps = True
+            elif o == '--process':
+                process = True
+            elif o in ('-s', '--stats'):
+                statsInterval = float(a)
+            elif o == '--serve':
+                servePort = int(a)
+            elif o in ('-v', '--verbose'):
+                verbose = True
+    except ValueError, e:
+        print >> sys.stderr, "Invalid option value: %s" % e
+        return 1
+    if not port:
+        usage()
+        return 1
+
+    c = CANController.CANUSBController(port, bitrate, timestamps, STORE_CAPACITY, verbose)
+    if stdIDs or extIDs:
+        c.SetAcceptanceFilter(stdIDs, extIDs)
+    try:
+        c.SetRxFilter(expression)
+    except CANFilter.FilterError, e:
+        print >> sys.stderr, "Invalid filter: %s" % e
+        return 1
+
+    # the driver prints its status messages, keep them out of the frames
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    subscription = None
+    if output == "-":
+        text = True
+    elif text:
+        out = open(output, 'w', 1 << 20)
+    else:
+        c.StartRecording(output, maxBytes, maxSeconds)
+    if text:
+        subscription = c.Subscribe(QUEUE_LEN, CANController.Subscription.DROP_OLDEST)
+    server = None
+    if servePort is not None:
+        server = CANServer.FrameServer(c, port=servePort)
+        server.start()
+
+    try:
+        c.Start(None, process)
+    except (lawicel_canusb.CANUSBError, EnvironmentError), e:
+        c.Stop()
+        print >> sys.stderr, "Cannot open %s: %s" % (port, e)
+        return 1
+
+    start = time.time()
+    lastCount, lastTime = 0, start
+    nextStats = start + statsInterval
+    status = 0
+    try:
+        try:
+            while duration <= 0 or time.time() - start < duration:
+                recording = c.GetRecordingStats()
+                if recording and recording[3]:
+                    print >> sys.stderr, "Cannot record to %s: %s" % (output, recording[3])
+                    status = 1
+                    break
+                if subscription:
+                    frames = subscription.get(0.1)
+                    if frames:
+                        out.write("".join([format_frame(f) for f in frames]))
+                else:
+                    time.sleep(0.1)
+                if statsInterval > 0 and time.time() >= nextStats:
+                    lastCount, lastTime = print_stats(c, subscription, start, lastCount, lastTime)
+                    nextStats = nextStats + statsInterval
+        except KeyboardInterrupt:
+            pass
+    finally:
+        if server:
+            server.stop()
+        # the worker counters are gone once stopped
+        stats = c.GetStats()
+        c.Stop()
+        if subscription:
+            frames = subscription.get(0)
+            out.write("".join([format_frame(f) for f in frames]))
+            out.flush()
+            if out is not sys.__stdout__:
+                out.close()
+        if statsInterval > 0:
+            print_stats(c, subscription, start, lastCount, lastTime, stats)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,8 @@
 import lawicel_canusb
+import CANLog
+import CANFilter
+import CANProcess
+import CANBusLoad
 import time
 import sys
 if sys.platform == "win32":
@@ -6,42 +10,837 @@ if sys.platform == "win32":
 else:
     from time import time as getts
 import threading
-import copy
+import array
+import heapq
+import math
 from collections import deque
 
-frames=[]
-frameCounts={}
-lastFramesByID={}
+# Default number of frames kept in memory
+DEFAULT_CAPACITY = 1000000
+
+# Longest time the worker waits for incoming data before checking
+# whether there is something to transmit
+POLL_TIMEOUT = 0.1
+
+
+class FrameStore(object):
+    """Fixed capacity store for the captured frames.
+
+    Frames are kept in preallocated parallel arrays (timestamp, id, flags,
+    dlc and 8 data bytes per frame) instead of frame objects. Once the
+    store is full the oldest frames are overwritten. Frames are addressed
+    by their sequence number, which keeps counting up after wraparound;
+    only the last capacity frames can be read back.
+    """
+    # flags bits
+    XTD = 0x01
+    RTR = 0x02
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._capacity = capacity
+        self._timestamps = array.array('d', [0.0]) * capacity
+        self._ids = array.array('I', [0]) * capacity
+        self._flags = array.array('B', [0]) * capacity
+        self._dlcs = array.array('B', [0]) * capacity
+        self._data = bytearray(8 * capacity)
+        self._count = 0  # sequence number of the next frame
+
+    def append(self, f):
+        i = self._count % self._capacity
+        self._timestamps[i] = f.timestamp
+        self._ids[i] = f.msg_id
+        self._flags[i] = f.xtd | (f.rtr << 1)
+        self._dlcs[i] = f.ndata
+        self._data[8*i:8*i+8] = f.get_data()
+        self._count = self._count + 1
+
+    def extend(self, frames):
+        for f in frames:
+            self.append(f)
+
+    def get(self, seq):
+        """Return the frame with sequence number seq, or None if it is not
+        in the store (not received yet or overwritten).
+        """
+        if seq < self.get_first() or seq >= self._count:
+            return None
+        i = seq % self._capacity
+        ndata = self._dlcs[i]
+        flags = self._flags[i]
+        if flags & self.RTR:
+            # remote frames carry a DLC but no data, as when received
+            data = ()
+        else:
+            data = tuple(self._data[8*i:8*i+ndata])
+        return lawicel_canusb.CANUSBFrame(self._ids[i], flags & self.XTD, (flags & self.RTR) >> 1,
+                                          ndata, data, self._timestamps[i])
+
+    def get_first(self):
+        """Sequence number of the oldest frame in the store"""
+        return max(0, self._count - self._capacity)
+
+    def get_total_count(self):
+        """Number of frames stored since the last clear, including the
+        ones overwritten since
+        """
+        return self._count
+
+    def get_count(self):
+        """Number of frames currently in the store"""
+        return min(self._count, self._capacity)
+
+    def get_capacity(self):
+        return self._capacity
+
+    def get_memory_usage(self):
+        """Bytes allocated for the frames"""
+        return sys.getsizeof(self._timestamps) + sys.getsizeof(self._ids) + \
+               sys.getsizeof(self._flags) + sys.getsizeof(self._dlcs) + \
+               sys.getsizeof(self._data)
+
+    def clear(self):
+        self._count = 0
+
+
+class IDStats(object):
+    __slots__ = ('count', 'lastFrame', 'version', 'row',
+                 'firstTime', 'lastTime', 'minInterval', 'maxInterval',
+                 'ewmaInterval', 'ewmaVariance', 'windowStart', 'windowCount', 'prevWindowCount')
+
+    def __init__(self, row):
+        self.count = 0
+        self.lastFrame = None
+        self.version = 0
+        self.row = row
+        self.firstTime = None
+        self.lastTime = None
+        self.minInterval = None
+        self.maxInterval = 0.0
+        self.ewmaInterval = 0.0
+        self.ewmaVariance = 0.0
+        self.windowStart = 0.0
+        self.windowCount = 0      # frames since windowStart
+        self.prevWindowCount = 0  # frames in the window before
+
+
+class IDTable(object):
+    """Frame count and last frame of each ID, updated in place.
+
+    Each batch of frames added bumps the table version. The IDs updated by
+    the most recent batches are logged so that readers can fetch only the
+    entries changed since the version they last saw. Frames are never
+    modified once received, so entries are handed out without copying.
+
+    Each ID also gets a stable row, in order of first appearance, for the
+    "one line per ID" view. A change map flags the rows whose payload
+    changed since they were last collected with take_changed_rows().
+
+    The timing of each ID is tracked from the frame timestamps with a
+    constant amount of work per frame: an exponentially weighted average
+    and variance of the inter-arrival time, its minimum, maximum and
+    mean, and the frame count of the current and previous RATE_WINDOW,
+    from which get_timing() interpolates a sliding window rate. Without
+    hardware timestamps the frames of one serial read share the same
+    timestamp, so short intervals are only meaningful with them.
+    """
+    CHANGE_LOG_LEN = 256
+    RATE_WINDOW = 1.0      # seconds
+    EWMA_WEIGHT = 1.0 / 16
+
+    def __init__(self):
+        self._entries = {}
+        self._changes = deque(maxlen=self.CHANGE_LOG_LEN)  # (version, IDs)
+        self._resetVersion = 0
+        self._rows = []                # IDStats by row
+        self._changedMap = bytearray() # 1 for rows with a new payload
+        self._changedRows = []
+        self.version = 0
+
+    def update(self, frames):
+        if not frames:
+            return
+        version = self.version + 1
+        entries = self._entries
+        changed = set()
+        changedMap = self._changedMap
+        window = self.RATE_WINDOW
+        alpha = self.EWMA_WEIGHT
+        for f in frames:
+            msg_id = f.msg_id
+            e = entries.get(msg_id)
+            if e is None:
+                e = entries[msg_id] = IDStats(len(self._rows))
+                self._rows.append(e)
+                changedMap.append(0)
+            last = e.lastFrame
+            if last is None or last.data != f.data or last.ndata != f.ndata or last.rtr != f.rtr:
+                if not changedMap[e.row]:
+                    changedMap[e.row] = 1
+                    self._changedRows.append(e.row)
+            e.count = e.count + 1
+            e.lastFrame = f
+
+            ts = f.timestamp
+            last = e.lastTime
+            if last is None:
+                e.firstTime = ts
+                e.windowStart = ts
+            else:
+                interval = max(ts - last, 0.0)
+                if e.minInterval is None:
+                    e.minInterval = interval
+                    e.ewmaInterval = interval
+                else:
+                    if interval < e.minInterval:
+                        e.minInterval = interval
+                    diff = interval - e.ewmaInterval
+                    increment = alpha * diff
+                    e.ewmaInterval = e.ewmaInterval + increment
+                    e.ewmaVariance = (1.0 - alpha) * (e.ewmaVariance + diff * increment)
+                if interval > e.maxInterval:
+                    e.maxInterval = interval
+            e.lastTime = ts
+            elapsed = ts - e.windowStart
+            if elapsed >= window:
+                if elapsed >= 2 * window:
+                    e.prevWindowCount = 0
+                else:
+                    e.prevWindowCount = e.windowCount
+                e.windowStart = ts - elapsed % window
+                e.windowCount = 0
+            e.windowCount = e.windowCount + 1
+
+            if e.version != version:
+                e.version = version
+                changed.add(msg_id)
+        self._changes.append((version, changed))
+        self.version = version
+
+    def get_changed_since(self, version):
+        """Return (version, {id: (count, last frame)}, full). Only the
+        entries changed after the given version are returned, unless full
+        is True: then the result replaces everything the caller has, e.g.
+        after a clear or if the version is too old for the change log.
+        """
+        entries = self._entries
+        changes = self._changes
+        if version < self._resetVersion or not changes or version < changes[0][0] - 1:
+            return self.version, dict([(i, (e.count, e.lastFrame)) for i, e in entries.items()]), True
+        ids = set()
+        for v, changed in reversed(changes):
+            if v <= version:
+                break
+            ids.update(changed)
+        return self.version, dict([(i, (entries[i].count, entries[i].lastFrame)) for i in ids]), False
+
+    def get_counts(self):
+        return dict([(i, e.count) for i, e in self._entries.items()])
+
+    def get_timing(self, now, missingPeriods=3):
+        """Return {id: (count, average rate, window rate, min interval,
+        mean interval, max interval, jitter, missing)}. Rates are in frames
+        per second and times in seconds. The average rate is the inverse
+        of the weighted average interval, the jitter the weighted standard
+        deviation of the interval. An ID is missing when no frame was
+        received for more than missingPeriods average intervals, never
+        while its interval is still zero.
+        """
+        window = self.RATE_WINDOW
+        timing = {}
+        for i, e in self._entries.items():
+            elapsed = now - e.windowStart
+            if elapsed >= 2 * window:
+                windowRate = 0.0
+            elif elapsed >= window:
+                # the current window has ended without a frame
+                windowRate = e.windowCount * (2.0 - elapsed / window) / window
+            else:
+                windowRate = (e.prevWindowCount * (1.0 - elapsed / window) + e.windowCount) / window
+            if e.minInterval is None:
+                timing[i] = (e.count, 0.0, windowRate, 0.0, 0.0, 0.0, 0.0, False)
+                continue
+            if e.ewmaInterval > 0:
+                rate = 1.0 / e.ewmaInterval
+            else:
+                rate = 0.0
+            mean = (e.lastTime - e.firstTime) / (e.count - 1)
+            period = max(e.ewmaInterval, mean)
+            # no period is known while all the frames share a timestamp
+            missing = period > 0 and now - e.lastTime > missingPeriods * period
+            timing[i] = (e.count, rate, windowRate, e.minInterval, mean, e.maxInterval,
+                         math.sqrt(e.ewmaVariance), missing)
+        return timing
+
+    def get_last_frames(self):
+        return dict([(i, e.lastFrame) for i, e in self._entries.items()])
+
+    def get_row_count(self):
+        return len(self._rows)
+
+    def get_last_frame_by_row(self, row):
+        if row < len(self._rows):
+            return self._rows[row].lastFrame
+        return None
+
+    def get_last_frame(self, msg_id):
+        e = self._entries.get(msg_id)
+        if e is None:
+            return None
+        return e.lastFrame
+
+    def get_row(self, msg_id):
+        e = self._entries.get(msg_id)
+        if e is None:
+            return None
+        return e.row
+
+    def take_changed_rows(self):
+        """Return the rows whose payload changed since the last call"""
+        rows = self._changedRows
+        self._changedRows = []
+        for row in rows:
+            self._changedMap[row] = 0
+        return rows
+
+    def clear(self):
+        self._entries = {}
+        self._rows = []
+        self._changedMap = bytearray()
+        self._changedRows = []
+        self._changes.clear()
+        self.version = self.version + 1
+        self._resetVersion = self.version
+
+
+class LatencyHistogram(object):
+    """Counts durations in power of two buckets: bucket 0 holds durations
+    under 1 usec, bucket i those from 2**(i-1) to 2**i usec.
+    """
+    NUM_BUCKETS = 24
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        b = int(seconds * 1000000).bit_length()
+        if b >= self.NUM_BUCKETS:
+            b = self.NUM_BUCKETS - 1
+        self.buckets[b] = self.buckets[b] + 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'buckets': list(self.buckets)}
+
+
+class WorkerStats(object):
+    """Counters and latency histograms of the worker loop stages. They are
+    only updated by the worker thread and read without locking.
+    """
+    STAGES = ('read', 'parse', 'lock', 'status', 'callback')
+
+    def __init__(self):
+        self.loops = 0
+        self.timeouts = 0
+        self.framesParsed = 0    # frames decoded from the dongle
+        self.framesFiltered = 0  # frames dropped by the acceptance filter
+        self.framesSent = 0
+        self.txQueueDepth = 0
+        self.txQueueMax = 0
+        self.histograms = dict([(stage, LatencyHistogram()) for stage in self.STAGES])
+
+    def snapshot(self, canusb=None):
+        stats = {'loops': self.loops,
+                 'timeouts': self.timeouts,
+                 'frames_parsed': self.framesParsed,
+                 'frames_filtered': self.framesFiltered,
+                 'frames_sent': self.framesSent,
+                 'tx_queue_depth': self.txQueueDepth,
+                 'tx_queue_max': self.txQueueMax}
+        if canusb:
+            stats['bytes_read'] = canusb.bytes_read
+            stats['parser_dropped'] = canusb.get_parser_dropped()
+            stats['tx_in_flight'] = canusb.get_tx_pending()
+            stats['tx_failed'] = canusb.tx_failed
+            if isinstance(canusb, CANProcess.ProcessLink):
+                stats['ring_lost'] = canusb.ring_lost
+        for stage, h in self.histograms.items():
+            stats[stage] = h.snapshot()
+        return stats
+
+
+class ScheduledFrame(object):
+    def __init__(self, f, period, due):
+        self.frame = f
+        self.period = period  # seconds, 0 to send at every opportunity
+        self.due = due
+        self.generation = 0   # bumped when the entry is re-queued
+        self.count = 0
+        self.lastSent = None
+        self.intervalSum = 0.0
+        self.intervalSqSum = 0.0
+        self.maxLateness = 0.0
+        self.missed = 0
+
+
+class TxScheduler(object):
+    """Sends frames periodically, each one with its own period.
+
+    Entries are kept in a heap ordered by due time, so finding the frames
+    due is O(log n) per frame sent. An entry that falls behind by more
+    than one period skips the missed sends instead of bursting them, and
+    keeps its phase. Entries can be added, updated and removed while the
+    worker thread is running.
+    """
+    # Fraction of the period used to spread the phases of new entries
+    PHASE_STEP = 0.618034
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._nextHandle = 0
+        self._lock = threading.Lock()
+
+    def add(self, f, intervalms, phasems=None, now=None):
+        """Schedule frame f every intervalms milliseconds, starting phasems
+        milliseconds from now. Without a phase, entries are spread over
+        their period. Returns a handle for update() and remove().
+        """
+        if now is None:
+            now = getts()
+        period = max(intervalms, 0) / 1000.0
+        self._lock.acquire()
+        handle = self._nextHandle
+        self._nextHandle = handle + 1
+        if phasems is None:
+            phase = period * ((handle * self.PHASE_STEP) % 1.0)
+        else:
+            phase = phasems / 1000.0
+        entry = ScheduledFrame(f, period, now + phase)
+        self._entries[handle] = entry
+        heapq.heappush(self._heap, (entry.due, handle, entry.generation))
+        self._lock.release()
+        return handle
+
+    def update(self, handle, f=None, intervalms=None):
+        """Change the frame and/or the period of an entry. A new period
+        takes effect from the last time the frame was sent.
+        """
+        self._lock.acquire()
+        entry = self._entries.get(handle)
+        if entry:
+            if f is not None:
+                entry.frame = f
+            if intervalms is not None:
+                entry.period = max(intervalms, 0) / 1000.0
+                if entry.lastSent is not None:
+                    entry.due = entry.lastSent + entry.period
+                entry.generation = entry.generation + 1
+                heapq.heappush(self._heap, (entry.due, handle, entry.generation))
+        self._lock.release()
+
+    def remove(self, handle):
+        self._lock.acquire()
+        self._entries.pop(handle, None)
+        self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        self._entries.clear()
+        self._heap = []
+        self._lock.release()
+
+    def get_due(self, now):
+        """Return the frames due at time now and schedule their next send"""
+        frames = []
+        requeue = []
+        self._lock.acquire()
+        # clear() replaces the heap, only take it under the lock
+        heap = self._heap
+        entries = self._entries
+        while heap and heap[0][0] <= now:
+            due, handle, generation = heapq.heappop(heap)
+            entry = entries.get(handle)
+            if entry is None or entry.generation != generation:
+                # removed or re-queued since
+                continue
+            frames.append(entry.frame)
+
+            lateness = now - due
+            if lateness > entry.maxLateness:
+                entry.maxLateness = lateness
+            if entry.lastSent is not None:
+                interval = now - entry.lastSent
+                entry.intervalSum = entry.intervalSum + interval
+                entry.intervalSqSum = entry.intervalSqSum + interval * interval
+            entry.lastSent = now
+            entry.count = entry.count + 1
+
+            if entry.period > 0:
+                due = due + entry.period
+                if due <= now:
+                    missed = int((now - due) / entry.period) + 1
+                    entry.missed = entry.missed + missed
+                    due = due + missed * entry.period
+            else:
+                due = now
+            entry.due = due
+            requeue.append((due, handle, generation))
+        for item in requeue:
+            heapq.heappush(heap, item)
+        self._lock.release()
+        return frames
+
+    def get_next_due(self):
+        """Time the next frame is due, None if nothing is scheduled"""
+        self._lock.acquire()
+        heap = self._heap
+        while heap:
+            due, handle, generation = heap[0]
+            entry = self._entries.get(handle)
+            if entry is not None and entry.generation == generation:
+                break
+            heapq.heappop(heap)
+        if heap:
+            due = heap[0][0]
+        else:
+            due = None
+        self._lock.release()
+        return due
+
+    def get_stats(self):
+        """Return {handle: (msg_id, period, count, achieved period,
+        period jitter, max lateness, missed)}, times in seconds. The
+        jitter is the standard deviation of the achieved period.
+        """
+        stats = {}
+        self._lock.acquire()
+        for handle, e in self._entries.items():
+            n = e.count - 1
+            if n > 0:
+                mean = e.intervalSum / n
+                jitter = math.sqrt(max(e.intervalSqSum / n - mean * mean, 0.0))
+            else:
+                mean = 0.0
+                jitter = 0.0
+            stats[handle] = (e.frame.get_msg_id(), e.period, e.count, mean, jitter, e.maxLateness, e.missed)
+        self._lock.release()
+        return stats
+
+
+class CaptureReplay(object):
+    """Transmits the frames of a capture file with their original timing.
+
+    Frames are read from the CANLog.CaptureReader one at a time as they
+    become due. Their due time is the time since the first frame of the
+    capture divided by speed, speed 0 sending them as fast as the dongle
+    acks them. All the frames due when the worker polls are returned
+    together so they go out in a single write. The timing error is the
+    time between when a frame was due and when it was handed to the
+    dongle. close() closes the reader once the worker no longer uses it.
+    """
+    # Most frames sent per batch, as fast as possible or when late
+    MAX_BATCH = 64
+
+    # stdIDs, extIDs -- only replay these IDs, all frames if both are empty
+    # loops -- number of times the capture is played, 0 to loop forever
+    def __init__(self, reader, speed=1.0, stdIDs=(), extIDs=(), loops=1):
+        self._reader = reader
+        self._speed = speed
+        if stdIDs or extIDs:
+            self._ids = (frozenset(stdIDs), frozenset(extIDs))
+        else:
+            self._ids = None
+        self._loops = loops
+        self._lock = threading.Lock()
+        self._index = 0
+        self._next = None      # next frame to send and its due time
+        self._nextDue = None
+        self._t0 = None        # time the first frame of the loop is due
+        self._base = None      # timestamp of the first frame of the capture
+        self._lastDue = None
+        self.loopsDone = 0
+        self.sent = 0
+        self.finished = False
+        self.errorSum = 0.0
+        self.errorSqSum = 0.0
+        self.maxError = 0.0
+
+    def __peek(self, now):
+        """Read the next frame to replay, None at the end of the capture"""
+        reader = self._reader
+        count = reader.GetTotalFrameCount()
+        ids = self._ids
+        while 1:
+            if self._index >= count:
+                self.loopsDone = self.loopsDone + 1
+                if self.sent == 0 or (self._loops > 0 and self.loopsDone >= self._loops):
+                    self.finished = True
+                    return None
+                # the next loop starts where the previous one ended
+                self._index = 0
+                self._t0 = self._lastDue
+            f = reader.GetFrame(self._index)
+            self._index = self._index + 1
+            if ids is None or f.msg_id in ids[f.xtd]:
+                break
+        if self._base is None:
+            self._base = f.timestamp
+            self._t0 = now
+        if self._speed > 0:
+            due = self._t0 + (f.timestamp - self._base) / self._speed
+        else:
+            due = now
+        self._next = f
+        self._nextDue = due
+        return f
+
+    def get_due(self, now):
+        """Return the frames due at time now"""
+        self._lock.acquire()
+        try:
+            return self.__get_due(now)
+        finally:
+            self._lock.release()
+
+    def __get_due(self, now):
+        frames = []
+        while len(frames) < self.MAX_BATCH and not self.finished:
+            if self._next is None and self.__peek(now) is None:
+                break
+            due = self._nextDue
+            if due > now:
+                break
+            frames.append(self._next)
+            self._next = None
+            self._lastDue = due
+            self.sent = self.sent + 1
+            error = now - due
+            self.errorSum = self.errorSum + error
+            self.errorSqSum = self.errorSqSum + error * error
+            if error > self.maxError:
+                self.maxError = error
+        return frames
+
+    def stop(self):
+        self.finished = True
+
+    def close(self):
+        """Stop the replay and close the capture file"""
+        self._lock.acquire()
+        self.finished = True
+        self._reader.Close()
+        self._lock.release()
+
+    def get_next_due(self):
+        """Time the next frame is due, None once the replay is finished"""
+        if self.finished:
+            return None
+        if self._next is None:
+            # the next frame is read at the next poll
+            return getts()
+        return self._nextDue
+
+    def get_stats(self):
+        """Return (frames sent, loops done, finished, mean timing error,
+        RMS timing error, max timing error), times in seconds
+        """
+        if self.sent:
+            mean = self.errorSum / self.sent
+            rms = math.sqrt(self.errorSqSum / self.sent)
+        else:
+            mean = 0.0
+            rms = 0.0
+        return (self.sent, self.loopsDone, self.finished, mean, rms, self.maxError)
+
+
+class Subscription(object):
+    """Bounded queue of received frames for one consumer.
+
+    The worker puts every batch of frames it keeps and the consumer takes
+    them with get(). When more than maxFrames frames are waiting, the
+    policy decides which are lost: DROP_OLDEST discards the oldest queued
+    frames, DROP_NEWEST the incoming ones, BLOCK makes the worker wait up
+    to timeout seconds for the consumer before dropping the incoming
+    frames. After a wait times out the subscription is stalled and drops
+    the incoming frames without waiting until the consumer empties the
+    queue, so a stalled consumer never slows the acquisition down for
+    more than one wait.
+    """
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    BLOCK = 'block'
+
+    # predicate -- function returning the frames of a list this consumer
+    #              wants, see CANFilter.compile_filter, None for all
+    def __init__(self, maxFrames=10000, policy=DROP_OLDEST, timeout=0.1, predicate=None):
+        if policy not in (self.DROP_OLDEST, self.DROP_NEWEST, self.BLOCK):
+            raise ValueError("Unknown subscription policy %r" % (policy,))
+        self.maxFrames = maxFrames
+        self.policy = policy
+        self.timeout = timeout
+        self._predicate = predicate
+        self._batches = deque()
+        self._queued = 0
+        self._cond = threading.Condition(threading.Lock())
+        self.closed = False
+        self.stalled = False  # BLOCK wait timed out, not emptied since
+        self.received = 0   # frames queued
+        self.lost = 0       # frames dropped because the consumer was too slow
+
+    def put(self, frames):
+        if self._predicate:
+            frames = self._predicate(frames)
+        if not frames:
+            return
+        cond = self._cond
+        cond.acquire()
+        try:
+            if self.closed:
+                return
+            free = self.maxFrames - self._queued
+            if self.policy == self.BLOCK and free < len(frames) and not self.stalled:
+                deadline = time.time() + self.timeout
+                while free < len(frames) and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stalled = True
+                        break
+                    cond.wait(remaining)
+                    free = self.maxFrames - self._queued
+            if self.policy == self.DROP_OLDEST:
+                # a batch larger than the queue only keeps its end
+                if len(frames) > self.maxFrames:
+                    self.lost = self.lost + len(frames) - self.maxFrames
+                    frames = frames[len(frames) - self.maxFrames:]
+                excess = self._queued + len(frames) - self.maxFrames
+                while excess > 0:
+                    oldest = self._batches[0]
+                    if len(oldest) <= excess:
+                        self._batches.popleft()
+                        n = len(oldest)
+                    else:
+                        self._batches[0] = oldest[excess:]
+                        n = excess
+                    self._queued = self._queued - n
+                    self.lost = self.lost + n
+                    excess = excess - n
+            elif free < len(frames):
+                self.lost = self.lost + len(frames) - max(free, 0)
+                frames = frames[:max(free, 0)]
+            if frames:
+                self._batches.append(frames)
+                self._queued = self._queued + len(frames)
+                self.received = self.received + len(frames)
+                cond.notify()
+        finally:
+            cond.release()
+
+    def get(self, timeout=None):
+        """Return the frames queued since the last call, waiting up to
+        timeout seconds (forever if None) for some to arrive. Returns an
+        empty list on timeout or once the subscription is closed.
+        """
+        cond = self._cond
+        cond.acquire()
+        try:
+            if not self._batches and not self.closed and timeout != 0:
+                if timeout is None:
+                    while not self._batches and not self.closed:
+                        # a timeout keeps the wait interruptible
+                        cond.wait(1.0)
+                else:
+                    cond.wait(timeout)
+            frames = []
+            for batch in self._batches:
+                frames.extend(batch)
+            self._batches.clear()
+            self._queued = 0
+            self.stalled = False
+            cond.notify()
+        finally:
+            cond.release()
+        return frames
+
+    def get_queued(self):
+        return self._queued
+
+    def close(self):
+        self._cond.acquire()
+        self.closed = True
+        self._cond.notifyAll()
+        self._cond.release()
+
 
 class WorkerThread(threading.Thread):
-    def __init__(self, canusb, lock, callback):
+    def __init__(self, canusb, lock, callback, rxFilter=None, store=None, scheduler=None, idTable=None,
+                 busLoad=None, verbose=True):
         threading.Thread.__init__(self)
         self._canusb = canusb
+        self._verbose = verbose
+        self._frames = store
+        if idTable is None:
+            idTable = IDTable()
+        self._ids = idTable
+        self._bus_load = busLoad
         self._abort = 0
         self._tx_frames = deque()
-        self._tx_scheduled_frames = []
+        if scheduler is None:
+            scheduler = TxScheduler()
+        self._scheduler = scheduler
+        self._tx_failures = deque(maxlen=1000)
         self._lock = lock
         self._callback = callback
+        self._rx_filter = rxFilter
+        self._new_filter = None
+        self._recorder = None
+        self._replay = None
+        self._rx_predicate = None
+        self._trigger = None
+        self._subscribers = ()
+        self.stats = WorkerStats()
         
     def run(self):
-        global frames
-        global frameCounts
-        global lastFramesByID
-        
-        frames=[]
-        frameCounts={}
-        lastFrameByID={}
+        frames = self._frames
+        idTable = self._ids
+        self._lock.acquire()
+        frames.clear()
+        idTable.clear()
+        self._lock.release()
         
         startTime = getts()
         lastRefresh = startTime
         lastErrorCheck = startTime
+        stats = self.stats
+        hRead = stats.histograms['read']
+        hParse = stats.histograms['parse']
+        hLock = stats.histograms['lock']
         while not self._abort:
+            stats.loops = stats.loops + 1
+            # Program a new acceptance filter, which is only possible
+            # while the channel is closed
+            if self._new_filter:
+                code, mask, self._rx_filter = self._new_filter
+                self._new_filter = None
+                self._canusb.close_channel()
+                self._canusb.set_acc_code(code)
+                self._canusb.set_acc_mask(mask)
+                self._canusb.open_channel()
+                
             # Check for bus errors once per second
             if (getts()-lastErrorCheck) > 1.0:
                 lastErrorCheck = getts()
                 status_response = self._canusb.get_status_flags()
+                stats.histograms['status'].add(getts() - lastErrorCheck)
                 
-                print status_response
+                if self._verbose:
+                    print status_response
                 
                 if len(status_response) > 2:      
                     # status is 'F' followed by  2 bytes of hexadecimal BCD that represent the 8 bit status
@@ -74,76 +873,275 @@ class WorkerThread(threading.Thread):
                         print "Bus status changed: 0x%x %s" % (status, status_message)
                         
             
-            # Check whether it is time to send scheduled frames
-            # and insert scheduled frames in the tx queue
-            if 0 == len(self._tx_frames):
-                for f in self._tx_scheduled_frames:
-                    self._tx_frames.appendleft(f) 
+            # Send the scheduled frames that are due together with the
+            # frames waiting in the tx queue
+            now = getts()
+            batch = self._scheduler.get_due(now)
+            replay = self._replay
+            if replay:
+                batch.extend(replay.get_due(now))
+            stats.txQueueDepth = len(self._tx_frames)
+            if stats.txQueueDepth > stats.txQueueMax:
+                stats.txQueueMax = stats.txQueueDepth
+            while self._tx_frames:
+                batch.append(self._tx_frames.pop())
+            stats.framesSent = stats.framesSent + len(batch)
                     
+            t = getts()
             try:
-                # is it time to send a scheduled frame 
-                if len(self._tx_frames) > 0:
-                    # send any available frame, this will also read incoming frames
-                    f = self._tx_frames.pop()
-                    r = self._canusb.transmit_frame(f)
+                if batch:
+                    # send the frames in as few writes as the tx window
+                    # allows without waiting for their acks, acks are
+                    # collected while reading incoming frames
+                    self._canusb.queue_frames(batch)
                 else:
-                    # poll if there are no frames to send
-                    r = self._canusb.poll()
+                    # poll if there are no frames to send, until the next
+                    # scheduled frame is due
+                    timeout = POLL_TIMEOUT
+                    nextDue = self._scheduler.get_next_due()
+                    if replay:
+                        replayDue = replay.get_next_due()
+                        if replayDue is not None and (nextDue is None or replayDue < nextDue):
+                            nextDue = replayDue
+                    if nextDue is not None:
+                        timeout = min(max(nextDue - getts(), 0.0), timeout)
+                    self._canusb.poll(timeout)
             except lawicel_canusb.CANUSBError, e:
                 # re-raise error if it's not timeout
                 if str(e).find("timeout") < 0:
                     raise
                 else:
+                    stats.timeouts = stats.timeouts + 1
                     continue
+            hRead.add(getts() - t)
+            
+            txResults = self._canusb.get_tx_results()
+            for f, ok in txResults:
+                if not ok:
+                    self._tx_failures.append(f)
+            txFrames = [f for f, ok in txResults if ok]
+            txTime = time.time()
+            recorder = self._recorder
+            if recorder and txFrames:
+                # transmitted frames are stamped when the dongle acks them
+                recorder.add(txFrames, CANLog.FLAG_TX, txTime)
+            if self._bus_load:
+                self._bus_load.add(txFrames, txTime)
+            
+            t = getts()
+            rxFrames = self._canusb.get_rx_frames()
+            stats.framesParsed = stats.framesParsed + len(rxFrames)
+            if self._bus_load:
+                # the load is that of the wire, count every frame seen
+                # before the filters (the dongle's own acceptance filter
+                # still hides the frames it rejects)
+                self._bus_load.add(rxFrames)
+            if self._rx_filter and rxFrames:
+                # drop the frames the acceptance filter could not reject
+                stdIDs, extIDs = self._rx_filter
+                n = len(rxFrames)
+                rxFrames = [f for f in rxFrames if f.msg_id in (extIDs if f.xtd else stdIDs)]
+                stats.framesFiltered = stats.framesFiltered + n - len(rxFrames)
+            predicate = self._rx_predicate
+            if predicate and rxFrames:
+                n = len(rxFrames)
+                rxFrames = predicate(rxFrames)
+                stats.framesFiltered = stats.framesFiltered + n - len(rxFrames)
+            trigger = self._trigger
+            if trigger and rxFrames:
+                rxFrames = trigger.process(rxFrames)
+            t2 = getts()
+            hParse.add(t2 - t)
             
-            rxfifoLen = self._canusb.get_rxfifo_len()
             self._lock.acquire()
-            for i in range(0, rxfifoLen):
-                f = self._canusb.get_rx_frame()
-                frames.append(f)
-                if f.get_msg_id() not in frameCounts:
-                    frameCounts[f.get_msg_id()]=1
-                else:
-                    frameCounts[f.get_msg_id()]=frameCounts[f.get_msg_id()]+1
-                    
-                lastFramesByID[f.get_msg_id()]=f
+            t = getts()
+            frames.extend(rxFrames)
+            idTable.update(rxFrames)
+            t2 = getts()
             self._lock.release()
+            hLock.add(t2 - t)
+            
+            if recorder:
+                recorder.add(rxFrames)
+            
+            if rxFrames:
+                for subscriber in self._subscribers:
+                    subscriber.put(rxFrames)
             
                             
             # notify that new frames have been received if a callback
             # was provided
             # Only notify 5 times/s or every 100 frames to avoid 
             # over-loading the UI thread with events 
-            if (self._callback != None) and ((len(frames) % 100 == 0) or ((getts()-lastRefresh) > 0.2)): 
-                self._callback(len(frames))
+            if (self._callback != None) and ((frames.get_total_count() % 100 == 0) or ((getts()-lastRefresh) > 0.2)): 
+                t = getts()
+                self._callback(frames.get_total_count())
                 lastRefresh = getts()
+                stats.histograms['callback'].add(lastRefresh - t)
                                                     
     def abort(self):
         self._abort = 1
         
+    # rxFilter -- (standard IDs, extended IDs) sets of the frames to keep,
+    #             None to keep all frames
+    def set_filter(self, code, mask, rxFilter):
+        self._new_filter = (code, mask, rxFilter)
+        
+    # predicate -- function returning the frames of a list to keep, see
+    #              CANFilter.compile_filter, None to keep all frames
+    def set_rx_predicate(self, predicate):
+        self._rx_predicate = predicate
+        
+    # trigger -- CANFilter.Trigger deciding which of the frames left by
+    #            the filters are kept, None to keep all of them
+    def set_trigger(self, trigger):
+        self._trigger = trigger
+        
+    # subscribers -- tuple of Subscription fed with the frames kept,
+    #                replaced as a whole so the worker never sees it change
+    def set_subscribers(self, subscribers):
+        self._subscribers = subscribers
+        
     def send(self, f):
         self._tx_frames.appendleft(f)
         
+    def send_frames(self, frames):
+        self._tx_frames.extendleft(frames)
+        
     def schedule(self, f, intervalms):
-        self._tx_scheduled_frames.append(f)
+        return self._scheduler.add(f, intervalms)
+        
+    # recorder -- CANLog.CaptureRecorder fed with every frame received
+    #             and transmitted, None to stop recording
+    def set_recorder(self, recorder):
+        self._recorder = recorder
+        
+    # replay -- CaptureReplay whose frames are sent as they become due,
+    #           None to stop replaying
+    def set_replay(self, replay):
+        self._replay = replay
+        
+    def get_tx_failures(self):
+        failures = []
+        while self._tx_failures:
+            failures.append(self._tx_failures.popleft())
+        return failures
         
         
 class CANUSBController(object):
-    def __init__(self, serialPort, speed):
+    # timestamps -- stamp received frames with the dongle's msec timer
+    #               instead of the time they are read on the host
+    # capacity -- number of frames kept in memory, older frames are
+    #             overwritten
+    # verbose -- print the dongle status flags read every second
+    def __init__(self, serialPort, speed, timestamps=False, capacity=DEFAULT_CAPACITY, verbose=True):
         self._serialPort = serialPort
         self._speed = speed
+        self._timestamps = timestamps
+        self._verbose = verbose
+        self._frames = FrameStore(capacity)
+        self._ids = IDTable()
+        self._scheduler = TxScheduler()
+        self._bus_load = CANBusLoad.BusLoadMeter(speed)
+        self._acc_code = None
+        self._acc_mask = None
+        self._rx_filter = None
+        self._recorder = None
+        self._recording = None
+        self._replay = None
+        self._rx_predicate = None
+        self._trigger = None
+        self._subscribers = ()
         self._worker = None
         self._canusb = None
         self._lock = threading.Lock()
         
-    def Start(self, callback):
-        self._canusb = lawicel_canusb.opencan(self._serialPort, self._speed)
+    # process -- read and parse the dongle output in a child process, see
+    #            CANProcess, so that a busy GUI can't delay the reads
+    def Start(self, callback, process=False):
+        if process:
+            self._canusb = CANProcess.ProcessLink(self._serialPort, self._speed, self._timestamps,
+                                                  self._acc_code, self._acc_mask)
+        else:
+            self._canusb = lawicel_canusb.opencan(self._serialPort, self._speed, self._timestamps,
+                                                  self._acc_code, self._acc_mask)
         
         if not self._worker:          
-            self._worker = WorkerThread(self._canusb, self._lock, callback)
+            self._worker = WorkerThread(self._canusb, self._lock, callback, self._rx_filter, self._frames,
+                                        self._scheduler, self._ids, self._bus_load, self._verbose)
+            self._worker.set_recorder(self._recorder)
+            self._worker.set_replay(self._replay)
+            self._worker.set_rx_predicate(self._rx_predicate)
+            self._worker.set_trigger(self._trigger)
+            self._worker.set_subscribers(self._subscribers)
             self._worker.start()
     
+    # Only receive the frames with the given standard and extended IDs.
+    # The dongle acceptance filter is set to reject as many other frames
+    # as possible and the remaining ones are dropped by the worker.
+    # Without any ID, all frames are received again.
+    def SetAcceptanceFilter(self, stdIDs=(), extIDs=()):
+        self._acc_code, self._acc_mask = lawicel_canusb.acceptance_filter(stdIDs, extIDs)
+        if stdIDs or extIDs:
+            self._rx_filter = (frozenset(stdIDs), frozenset(extIDs))
+        else:
+            self._rx_filter = None
+        if self._worker:
+            self._worker.set_filter(self._acc_code, self._acc_mask, self._rx_filter)
+    
+    # Only keep the received frames matching a filter expression, see
+    # CANFilter for the syntax. Frames dropped by the filter are neither
+    # stored, counted nor recorded. None or "" keeps all frames. Raises
+    # CANFilter.FilterError if the expression is invalid.
+    def SetRxFilter(self, expression):
+        if expression:
+            self._rx_predicate = CANFilter.compile_filter(expression)
+        else:
+            self._rx_predicate = None
+        if self._worker:
+            self._worker.set_rx_predicate(self._rx_predicate)
+        
+    # Only keep the frames around trigger events, see CANFilter.Trigger.
+    # The trigger applies to the frames left by the filters. A None
+    # start expression removes the trigger.
+    def SetTrigger(self, start, stop=None, preTrigger=0, postTrigger=0, rearm=False):
+        if start:
+            self._trigger = CANFilter.Trigger(start, stop, preTrigger, postTrigger, rearm)
+        else:
+            self._trigger = None
+        if self._worker:
+            self._worker.set_trigger(self._trigger)
+        
+    # Returns (state, number of times fired, frames dropped), None
+    # without trigger
+    def GetTriggerState(self):
+        trigger = self._trigger
+        if trigger:
+            return (trigger.state, trigger.count, trigger.dropped)
+        return None
+    
+    # Returns a Subscription receiving batches of the frames kept from
+    # now on, see Subscription for the policies. With an expression the
+    # subscription only gets the frames matching it, see CANFilter.
+    def Subscribe(self, maxFrames=10000, policy=Subscription.DROP_OLDEST, timeout=0.1, expression=None):
+        predicate = None
+        if expression:
+            predicate = CANFilter.compile_filter(expression)
+        subscription = Subscription(maxFrames, policy, timeout, predicate)
+        self._subscribers = self._subscribers + (subscription,)
+        if self._worker:
+            self._worker.set_subscribers(self._subscribers)
+        return subscription
+        
+    def Unsubscribe(self, subscription):
+        self._subscribers = tuple([s for s in self._subscribers if s is not subscription])
+        if self._worker:
+            self._worker.set_subscribers(self._subscribers)
+        subscription.close()
+        
     def Stop(self):
+        self._scheduler.clear()
+        self.StopReplay()
         try:
             if self._worker:
                 self._worker.abort()
@@ -151,54 +1149,211 @@ class CANUSBController(object):
                 self._worker = None
         finally:
             if self._canusb:
-                self._canusb.close_channel()
+                if isinstance(self._canusb, CANProcess.ProcessLink):
+                    self._canusb.close()
+                else:
+                    self._canusb.close_channel()
                 del self._canusb
                 self._canusb = None            
+            self.StopRecording()
+            
+    # Stream every frame received and transmitted to a capture file, see
+    # CANLog for the format. A new file is started every maxBytes bytes
+    # or maxSeconds seconds (0 for no limit) and the data is synced to
+    # disk every syncInterval seconds. Recording stops with the
+    # controller.
+    def StartRecording(self, path, maxBytes=0, maxSeconds=0, syncInterval=1.0):
+        self.StopRecording()
+        self._recorder = CANLog.CaptureRecorder(path, maxBytes, maxSeconds, syncInterval)
+        self._recorder.start()
+        if self._worker:
+            self._worker.set_recorder(self._recorder)
+        
+    # Returns (files written, frames recorded, frames dropped because the
+    # disk could not keep up, error that stopped the recording or None),
+    # None if not recording
+    def StopRecording(self):
+        recorder = self._recorder
+        if not recorder:
+            return None
+        if self._worker:
+            self._worker.set_recorder(None)
+        self._recorder = None
+        recorder.stop()
+        self._recording = (recorder.files, recorder.records, recorder.dropped, recorder.error)
+        return self._recording
+        
+    # Returns (files written, frames recorded, frames dropped, error) of
+    # the current or last recording, None if nothing was recorded
+    def GetRecordingStats(self):
+        recorder = self._recorder
+        if recorder:
+            return (list(recorder.files), recorder.records, recorder.dropped, recorder.error)
+        return self._recording
             
+    # index is the frame sequence number, from GetFirstFrameIndex() to
+    # GetTotalFrameCount()-1. Returns None for frames no longer in memory.
     def GetFrame(self, index):
-        global frames
-        f = None
         self._lock.acquire()
-        if index < len(frames):
-            f = frames[index]
+        f = self._frames.get(index)
         self._lock.release()
         return f
     
+    # Number of frames received since the capture was cleared
     def GetTotalFrameCount(self):
-        global frames
-        return len(frames)
+        return self._frames.get_total_count()
+    
+    # Number of frames still in memory
+    def GetFrameCount(self):
+        return self._frames.get_count()
+    
+    # Sequence number of the oldest frame still in memory
+    def GetFirstFrameIndex(self):
+        return self._frames.get_first()
+    
+    # Bytes allocated to keep the frames in memory
+    def GetMemoryUsage(self):
+        return self._frames.get_memory_usage()
     
     def GetFrameCounts(self):
-        global frameCounts
         self._lock.acquire()
-        counts = copy.deepcopy(frameCounts)
+        counts = self._ids.get_counts()
         self._lock.release()
         return counts
     
+    # Returns {id: (count, average rate, window rate, min interval, mean
+    # interval, max interval, jitter, missing)}, see IDTable.get_timing.
+    # missing is True for the IDs not received for more than
+    # missingPeriods times their usual interval.
+    def GetIDTiming(self, missingPeriods=3):
+        now = time.time()
+        self._lock.acquire()
+        timing = self._ids.get_timing(now, missingPeriods)
+        self._lock.release()
+        return timing
+    
     def GetLastFramesByID(self):
-        global lastFramesByID
         self._lock.acquire()
-        lastFrames = copy.deepcopy(lastFramesByID)
+        lastFrames = self._ids.get_last_frames()
         self._lock.release()
         return lastFrames
     
+    # Number of IDs received, i.e. of rows in the "one line per ID" view
+    def GetIDCount(self):
+        return self._ids.get_row_count()
+    
+    # Last frame of the ID at the given row, rows are numbered in the
+    # order the IDs were first received
+    def GetLastFrameByRow(self, row):
+        self._lock.acquire()
+        f = self._ids.get_last_frame_by_row(row)
+        self._lock.release()
+        return f
+    
+    def GetLastFrameByID(self, msg_id):
+        self._lock.acquire()
+        f = self._ids.get_last_frame(msg_id)
+        self._lock.release()
+        return f
+    
+    def GetRowOfID(self, msg_id):
+        self._lock.acquire()
+        row = self._ids.get_row(msg_id)
+        self._lock.release()
+        return row
+    
+    # Rows whose last frame has a different payload since the last call
+    def GetChangedRows(self):
+        self._lock.acquire()
+        rows = self._ids.take_changed_rows()
+        self._lock.release()
+        return rows
+    
+    # Returns (version, {id: (count, last frame)}, full) with the IDs
+    # updated since the given version. Pass the returned version to the
+    # next call. If full is True the result replaces all previous ones.
+    def GetIDStatsSince(self, version=0):
+        self._lock.acquire()
+        stats = self._ids.get_changed_since(version)
+        self._lock.release()
+        return stats
+    
     def ClearFrames(self):
-        global frames
-        global frameCounts
         self._lock.acquire()
-        frames = []
-        frameCounts = {}
+        self._frames.clear()
+        self._ids.clear()
         self._lock.release()
+        self._bus_load.clear()
+        
+    # Returns (load, peak load, {(msg_id, xtd): load}) over the last
+    # second, loads as fractions of the bitrate, counting the frames
+    # received and transmitted with their stuff bits
+    def GetBusLoad(self):
+        return self._bus_load.get_load(time.time())
+        
+    # Transmit the frames of a capture file (see CANLog) with their
+    # original timing, speed times faster (0 for as fast as possible).
+    # Only the frames with the given IDs are sent if any is given. The
+    # capture is played loops times, 0 to loop until StopReplay().
+    def StartReplay(self, path, speed=1.0, stdIDs=(), extIDs=(), loops=1):
+        self.StopReplay()
+        # the frames are read in order, no need for the index
+        reader = CANLog.CaptureReader(path, useIndexFile=False, buildIndex=False)
+        self._replay = CaptureReplay(reader, speed, stdIDs, extIDs, loops)
+        if self._worker:
+            self._worker.set_replay(self._replay)
+        
+    def StopReplay(self):
+        if self._worker:
+            self._worker.set_replay(None)
+        if self._replay:
+            self._replay.close()
+        
+    # Returns (frames sent, loops done, finished, mean timing error, RMS
+    # timing error, max timing error) of the last replay with times in
+    # seconds, None if no replay was started
+    def GetReplayStats(self):
+        if self._replay:
+            return self._replay.get_stats()
+        return None
+        
+    # Send each frame every intervalms milliseconds (0 for as often as
+    # possible) until unscheduled or the controller is stopped.
+    # Returns one handle per frame.
+    def ScheduleFrames(self, frames, intervalms=0, phasems=None):
+        return [self._scheduler.add(f, intervalms, phasems) for f in frames]
+        
+    def RescheduleFrames(self, handles, intervalms):
+        for h in handles:
+            self._scheduler.update(h, intervalms=intervalms)
+        
+    def UnscheduleFrames(self, handles):
+        for h in handles:
+            self._scheduler.remove(h)
+        
+    # Returns {handle: (msg_id, period, count, achieved period, jitter,
+    # max lateness, missed)} with times in seconds
+    def GetScheduleStats(self):
+        return self._scheduler.get_stats()
+        
+    # Snapshot of the worker loop counters and per-stage latency
+    # histograms, see WorkerStats
+    def GetStats(self):
+        if self._worker:
+            return self._worker.stats.snapshot(self._canusb)
+        return None
         
-    def ScheduleFrames(self, frames):
+    # Returns the frames the dongle refused to transmit (BELL) or
+    # never acknowledged since the last call
+    def GetTxFailures(self):
         if self._worker:
-            for f in frames:
-                self._worker.schedule(f, 0)
+            return self._worker.get_tx_failures()
+        return []
         
+    # The frames are written to the dongle with a single serial write
     def SendFrames(self, delays, frames):
         if self._worker:
-            for f in frames:
-                self._worker.send(f)
+            self._worker.send_frames(frames)
     
 if __name__ == "__main__":
     def print_callback(numFrames):
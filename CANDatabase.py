@@ -11,22 +11,53 @@ import os
 class CANDatabase(object):
     def __init__(self):
         self._db={}
+        self._signals=[]
         self._listeners=[]
         
     def GetSignals(self):
-        return self._db.items()
+        return [(sig.get_id(), sig) for sig in self._signals]
+    
+    def GetMessages(self):
+        return self._db.values()
     
     def FindSignalById(self, id):
         if self._db.has_key(id):
-            return self._db[id]
+            return self._db[id].get_signals()[0]
         return None
     
     def FindSignalByName(self, name):
-        for sig in self._db.values():
+        for sig in self._signals:
             if name == sig.get_name():
                 return sig
         return None
     
+    def FindMessageById(self, id):
+        return self._db.get(id)
+    
+    # Returns [(signal, value)] of the signals present in the frame, empty
+    # if the database has no message with its ID
+    def DecodeFrame(self, frame):
+        message = self._db.get(frame.get_msg_id())
+        if message is None:
+            return []
+        return message.decode(frame)
+    
+    # Signals with the same ID are grouped into a message named after the
+    # first one. The database is replaced at once so that frames can be
+    # decoded from another thread while it is updated.
+    def SetSignals(self, signals):
+        db = {}
+        for sig in signals:
+            message = db.get(sig.get_id())
+            if message is None:
+                message = db[sig.get_id()] = CANMessage.CANMessageDef(sig.get_name(), sig.get_id(), sig.get_xtd())
+            message.add_signal(sig)
+        self._db = db
+        self._signals = list(signals)
+        
+        for l in self._listeners:
+            l(signals)
+    
     # listeners are notified when the database is updated
     def AddListener(self, listener):
         self._listeners.append(listener)
@@ -43,24 +74,14 @@ class CANDatabase(object):
                 print "Can't open file " + dbPath + ". Error: " + e
             else:
                 # replace global copy of database with version loaded from file
-                self._db.clear()
-                for sig in signals:
-                    self._db[sig.get_id()]=sig
-                    
-                for l in self._listeners:
-                    l(signals)
+                self.SetSignals(signals)
                     
         return signals
                         
     def Save(self, dbPath, signals):  
         # replace global copy of database with new version
         # about to be saved
-        self._db.clear()
-        for sig in signals:
-            self._db[sig.get_id()]=sig
-            
-        for l in self._listeners:
-            l(signals)
+        self.SetSignals(signals)
             
         if len(dbPath) > 0:            
             # save signal list to file 
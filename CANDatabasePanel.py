@@ -98,6 +98,11 @@ class CANMessagePanel(wx.Panel):
         self.bitLength.Bind(wx.EVT_SPINCTRL, self.OnBitLengthChange)
         self.bitLengthBox.Add(self.bitLength)  
         
+        self.muxBox = wx.BoxSizer(wx.VERTICAL)
+        self.muxBox.Add(wx.StaticText(self, label="Mux (M or value)") , flag = wx.EXPAND)
+        self.mux = wx.TextCtrl(self, value="",size=(40,-1))
+        self.muxBox.Add(self.mux) 
+        
         self.valueBox = wx.BoxSizer(wx.VERTICAL)
         self.valueBox.Add(wx.StaticText(self, label="Value") , flag = wx.EXPAND)
         self.value = wx.TextCtrl(self, value="0",size=(80,-1),style=wx.TE_PROCESS_ENTER)
@@ -117,6 +122,7 @@ class CANMessagePanel(wx.Panel):
         self.hsizer.Add(self.endianessBox, flag=wx.ALL, border=5) 
         self.hsizer.Add(self.startBitBox, flag=wx.ALL, border=5) 
         self.hsizer.Add(self.bitLengthBox, flag=wx.ALL, border=5) 
+        self.hsizer.Add(self.muxBox, flag=wx.ALL, border=5) 
         self.hsizer.Add(self.valueBox, flag=wx.ALL, border=5)
         
         self.vsizer.Add(self.hsizer)
@@ -178,8 +184,16 @@ class CANMessagePanel(wx.Panel):
         startBit = self.startBit.GetValue()
         bitLength = self.bitLength.GetValue()
         value = float(self.value.GetValue())
+        # empty for a signal always present, M for the multiplexor
+        mux = self.mux.GetValue().strip()
+        if not mux:
+            mux = None
+        elif mux.upper() == CANMessage.CANSignal.MULTIPLEXOR:
+            mux = CANMessage.CANSignal.MULTIPLEXOR
+        else:
+            mux = int(mux, 0)
                 
-        return CANMessage.CANSignal(name, id, xtd, dType, endian, startBit, bitLength, value)
+        return CANMessage.CANSignal(name, id, xtd, dType, endian, startBit, bitLength, value, mux)
       
     def SetValue(self, message):
         self.name.SetValue(message.get_name())
@@ -189,7 +203,11 @@ class CANMessagePanel(wx.Panel):
         self.endianess.SetSelection(self.endianessesVal.index(message.get_endian().lower()))
         self.startBit.SetValue(message.get_startbit())
         self.bitLength.SetValue(message.get_bitlength())
-        self.value.SetValue("%f" % message.get_val())       
+        self.value.SetValue("%f" % message.get_val())
+        if message.get_mux() is None:
+            self.mux.SetValue("")
+        else:
+            self.mux.SetValue(str(message.get_mux()))       
         
         
 class CANMessageListPanel(wx.ScrolledWindow):
@@ -0,0 +1,316 @@
+'''
+Receive filter expressions and triggers
+
+A filter expression selects frames on their fields:
+
+    id, dlc, xtd, rtr    header fields
+    data[n]              data byte n, the comparison is false if the
+                         frame has fewer than n+1 bytes
+
+compared with ==, !=, <, <=, >, >= or "in", optionally after masking
+with &, and combined with and, or, not and parentheses. "in" takes a
+range or a list of values and ranges. Numbers are decimal or 0x hex.
+
+    id in 0x100-0x1ff and not rtr
+    id & 0x7f0 == 0x120 or id in (0x7df, 0x7e8-0x7ef)
+    xtd and data[0] & 0xf0 == 0x20 and dlc >= 4
+
+An expression is compiled once into a function taking a list of frames
+and returning the matching ones, so filtering a batch costs a single
+list comprehension.
+'''
+import re
+from collections import deque
+
+FIELDS = {
+    'id': 'f.msg_id',
+    'dlc': 'f.ndata',
+    'xtd': 'f.xtd',
+    'rtr': 'f.rtr',
+}
+
+COMPARISONS = ('==', '!=', '<=', '>=', '<', '>')
+
+TOKEN = re.compile(r'\s*(?:(0[xX][0-9a-fA-F]+|\d+)|(data\s*\[\s*\d\s*\])|([A-Za-z_]+)|(==|!=|<=|>=|<|>|&|-|\(|\)|,))')
+
+
+class FilterError(Exception):
+    pass
+
+
+def tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = TOKEN.match(expression, pos)
+        if not m:
+            raise FilterError("Syntax error at '%s'" % expression[pos:])
+        number, data, word, op = m.groups()
+        if number is not None:
+            tokens.append(('number', int(number, 0)))
+        elif data is not None:
+            tokens.append(('data', int(re.sub(r'\D', '', data))))
+        elif word is not None:
+            tokens.append(('word', word.lower()))
+        else:
+            tokens.append(('op', op))
+        pos = m.end()
+    return tokens
+
+
+class Parser(object):
+    """Translates a filter expression into a python expression on f"""
+
+    def __init__(self, expression):
+        self._tokens = tokenize(expression)
+        self._pos = 0
+        self.constants = {}   # sets of values used by the expression
+
+    def parse(self):
+        if not self._tokens:
+            raise FilterError("Empty filter expression")
+        source = self.__or()
+        if self._pos < len(self._tokens):
+            raise FilterError("Unexpected '%s'" % (self._tokens[self._pos][1],))
+        return source
+
+    def __peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def __next(self):
+        token = self.__peek()
+        if token[0] is None:
+            raise FilterError("Unexpected end of filter expression")
+        self._pos = self._pos + 1
+        return token
+
+    def __expect(self, kind, value=None):
+        token = self.__next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise FilterError("Expected %s, got '%s'" % (value or kind, token[1]))
+        return token[1]
+
+    def __or(self):
+        terms = [self.__and()]
+        while self.__peek() == ('word', 'or'):
+            self.__next()
+            terms.append(self.__and())
+        if len(terms) == 1:
+            return terms[0]
+        return '(' + ' or '.join(terms) + ')'
+
+    def __and(self):
+        factors = [self.__not()]
+        while self.__peek() == ('word', 'and'):
+            self.__next()
+            factors.append(self.__not())
+        if len(factors) == 1:
+            return factors[0]
+        return '(' + ' and '.join(factors) + ')'
+
+    def __not(self):
+        if self.__peek() == ('word', 'not'):
+            self.__next()
+            return '(not %s)' % self.__not()
+        if self.__peek() == ('op', '('):
+            self.__next()
+            source = self.__or()
+            self.__expect('op', ')')
+            return source
+        return self.__comparison()
+
+    def __comparison(self):
+        kind, value = self.__next()
+        guard = None
+        if kind == 'data':
+            if value > 7:
+                raise FilterError("Data byte index out of range: %d" % value)
+            field = 'f.data[%d]' % value
+            # remote frames have a DLC but no data
+            guard = '(f.ndata > %d and len(f.data) > %d)' % (value, value)
+        elif kind == 'word' and value in FIELDS:
+            field = FIELDS[value]
+        else:
+            raise FilterError("Unknown field '%s'" % (value,))
+
+        if self.__peek() == ('op', '&'):
+            self.__next()
+            field = '(%s & %d)' % (field, self.__expect('number'))
+
+        kind, op = self.__peek()
+        if kind == 'op' and op in COMPARISONS:
+            self.__next()
+            source = '%s %s %d' % (field, op, self.__expect('number'))
+        elif (kind, op) == ('word', 'in'):
+            self.__next()
+            source = self.__membership(field)
+        else:
+            # a bare field is true when not zero, as in "xtd and not rtr"
+            source = field
+
+        if guard:
+            return '(%s and %s)' % (guard, source)
+        return source
+
+    def __membership(self, field):
+        if self.__peek() == ('op', '('):
+            self.__next()
+            items = [self.__range()]
+            while self.__peek() == ('op', ','):
+                self.__next()
+                items.append(self.__range())
+            self.__expect('op', ')')
+        else:
+            items = [self.__range()]
+        values = [low for low, high in items if low == high]
+        tests = ['%d <= %s <= %d' % (low, field, high) for low, high in items if low != high]
+        if len(values) == 1:
+            tests.insert(0, '%s == %d' % (field, values[0]))
+        elif values:
+            name = '_values%d' % len(self.constants)
+            self.constants[name] = frozenset(values)
+            tests.insert(0, '%s in %s' % (field, name))
+        if len(tests) == 1:
+            return tests[0]
+        return '(' + ' or '.join(tests) + ')'
+
+    def __range(self):
+        low = self.__expect('number')
+        high = low
+        if self.__peek() == ('op', '-'):
+            self.__next()
+            high = self.__expect('number')
+            if high < low:
+                raise FilterError("Empty range 0x%x-0x%x" % (low, high))
+        return (low, high)
+
+
+def compile_filter(expression):
+    """Compile a filter expression into a function that takes a list of
+    frames and returns the frames matching it. Raises FilterError if the
+    expression is invalid.
+    """
+    parser = Parser(expression)
+    source = parser.parse()
+    return eval('lambda frames: [f for f in frames if %s]' % source, parser.constants)
+
+
+def compile_search(expression):
+    """Compile a filter expression into a function that takes a list of
+    frames and returns the index of the first frame matching it, -1 if
+    none does.
+    """
+    parser = Parser(expression)
+    source = parser.parse()
+    return eval('lambda frames: next((i for i, f in enumerate(frames) if %s), -1)' % source,
+                parser.constants)
+
+
+class Trigger(object):
+    """Only lets frames through around trigger events.
+
+    While armed, frames are dropped and the last preTrigger of them are
+    kept in a ring. When a frame matches the start expression the ring
+    and that frame are let through and the trigger fires. Frames then
+    pass until a frame matches the stop expression, followed by
+    postTrigger more frames. Without stop expression, postTrigger frames
+    pass after the start frame, or all of them if postTrigger is 0.
+    With rearm the trigger then waits for the next start event,
+    otherwise it drops everything from then on.
+    """
+    ARMED = 'armed'
+    TRIGGERED = 'triggered'
+    POST_TRIGGER = 'post-trigger'
+    DONE = 'done'
+
+    def __init__(self, start, stop=None, preTrigger=0, postTrigger=0, rearm=False):
+        self._start = compile_search(start)
+        if stop:
+            self._stop = compile_search(stop)
+        else:
+            self._stop = None
+        self._ring = deque(maxlen=max(preTrigger, 0))
+        self._postTrigger = postTrigger
+        self._rearm = rearm
+        self._remaining = 0
+        self.state = self.ARMED
+        self.count = 0       # number of times the trigger fired
+        self.dropped = 0     # frames dropped outside the trigger windows
+
+    def __hold(self, frames):
+        """Keep frames in the pre-trigger ring"""
+        ring = self._ring
+        overflow = len(ring) + len(frames) - ring.maxlen
+        if overflow > 0:
+            self.dropped = self.dropped + overflow
+        ring.extend(frames)
+
+    def __post_trigger(self, n):
+        if n > 0:
+            self.state = self.POST_TRIGGER
+            self._remaining = n
+        elif self._rearm:
+            self.state = self.ARMED
+        else:
+            self.state = self.DONE
+
+    def process(self, frames):
+        """Return the frames of the list to keep"""
+        out = []
+        while frames:
+            state = self.state
+            if state == self.ARMED:
+                i = self._start(frames)
+                if i < 0:
+                    self.__hold(frames)
+                    break
+                self.__hold(frames[:i])
+                out.extend(self._ring)
+                self._ring.clear()
+                out.append(frames[i])
+                frames = frames[i+1:]
+                self.count = self.count + 1
+                if self._stop is None and self._postTrigger > 0:
+                    self.__post_trigger(self._postTrigger)
+                else:
+                    self.state = self.TRIGGERED
+            elif state == self.TRIGGERED:
+                i = -1
+                if self._stop is not None:
+                    i = self._stop(frames)
+                if i < 0:
+                    out.extend(frames)
+                    break
+                out.extend(frames[:i+1])
+                frames = frames[i+1:]
+                self.__post_trigger(self._postTrigger)
+            elif state == self.POST_TRIGGER:
+                n = min(self._remaining, len(frames))
+                out.extend(frames[:n])
+                frames = frames[n:]
+                self.__post_trigger(self._remaining - n)
+            else:
+                self.dropped = self.dropped + len(frames)
+                break
+        return out
+
+
+if __name__ == "__main__":
+    import lawicel_canusb
+    # remote and short frames never match a data byte comparison
+    frames = lawicel_canusb.frames_from_ascii(['r1234', 'R123456788', 't1231aa', 't1232aabb', 't12300'])
+    for expression, expected in (('data[0] == 0xaa', [2, 3]),
+                                 ('data[1] in (0xbb, 0x00-0x10)', [3]),
+                                 ('not data[3] == 0', [0, 1, 2, 3, 4]),
+                                 ('rtr or data[0] & 0xf0 == 0xa0', [0, 1, 2, 3])):
+        selected = compile_filter(expression)(frames)
+        if selected != [frames[i] for i in expected]:
+            print "Error: %s selected %s" % (expression, [frames.index(f) for f in selected])
+        if compile_search(expression)(frames) != expected[0]:
+            print "Error: %s found %d" % (expression, compile_search(expression)(frames))
+    trigger = Trigger('data[0] == 0xaa')
+    if trigger.process(frames) != frames[2:]:
+        print "Error: trigger"
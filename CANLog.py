@@ -0,0 +1,447 @@
+'''
+Binary capture files
+
+A capture file starts with a 16 byte header followed by fixed size
+records, all little endian:
+
+    timestamp  float64  seconds since the epoch
+    msg_id     uint32
+    flags      uint8    FLAG_XTD | FLAG_RTR | FLAG_TX
+    dlc        uint8
+    data       8 bytes  padded with zeros
+    (2 padding bytes)
+'''
+import array
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+import CANMessage
+
+MAGIC = 'CANCAP'
+VERSION = 1
+HEADER = struct.Struct('<6sHII')       # magic, version, record size, reserved
+RECORD = struct.Struct('<dIBB8s2x')
+TIMESTAMP = struct.Struct('<d')
+INDEX_FIELDS = struct.Struct('<dIB')      # leading fields of a record
+
+FLAG_XTD = 0x01
+FLAG_RTR = 0x02
+FLAG_TX = 0x04   # frame transmitted by us rather than received
+
+
+def pack_frames(frames, flags=0, timestamp=None):
+    """Pack frames into a string of records. If a timestamp is given it
+    replaces the timestamp of every frame.
+    """
+    buf = bytearray(RECORD.size * len(frames))
+    pack_into = RECORD.pack_into
+    offset = 0
+    for f in frames:
+        if timestamp is None:
+            ts = f.timestamp
+        else:
+            ts = timestamp
+        pack_into(buf, offset, ts, f.msg_id, flags | f.xtd | (f.rtr << 1), f.ndata, str(bytearray(f.data)))
+        offset = offset + RECORD.size
+    return str(buf)
+
+
+def unpack_frame(buf, offset=0):
+    """Return the frame stored in the record at offset in buf and its flags"""
+    ts, msg_id, flags, dlc, data = RECORD.unpack_from(buf, offset)
+    if flags & FLAG_RTR:
+        # remote frames carry a DLC but no data
+        data = ()
+    else:
+        data = tuple(bytearray(data[:dlc]))
+    f = CANMessage.CANFrame(msg_id, flags & FLAG_XTD, (flags & FLAG_RTR) >> 1, dlc, data, ts)
+    return f, flags
+
+
+def write_header(f):
+    f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0))
+
+
+class CaptureRecorder(threading.Thread):
+    """Streams frames to capture files from its own thread.
+
+    add() only queues the frames, so the receive path never waits for the
+    disk. Frames are dropped and counted if more than maxQueued are
+    waiting. Writes go through a large buffer; the file is flushed and
+    synced to disk every syncInterval seconds. A new file is started once
+    the current one reaches maxBytes or is maxSeconds old. The first file
+    is path, the next ones get a number before the extension
+    (capture.1.cap, capture.2.cap, ...). If a file cannot be opened or
+    written the recording stops, error holds the reason and the frames
+    added afterwards are dropped.
+    """
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path, maxBytes=0, maxSeconds=0, syncInterval=1.0, maxQueued=1000000):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._path = path
+        self._maxBytes = maxBytes
+        self._maxSeconds = maxSeconds
+        self._syncInterval = syncInterval
+        self._maxQueued = maxQueued
+        self._queue = deque()
+        self._queued = 0
+        self._lock = threading.Lock()   # guards the queue and _queued
+        self._wakeup = threading.Event()
+        self._abort = 0
+        self._file = None
+        self.files = []
+        self.records = 0   # records written
+        self.dropped = 0   # frames dropped because the writer fell behind
+        self.error = None  # why the recording stopped early
+
+    def add(self, frames, flags=0, timestamp=None):
+        if not frames:
+            return
+        self._lock.acquire()
+        if self.error is not None or self._queued + len(frames) > self._maxQueued:
+            self.dropped = self.dropped + len(frames)
+            self._lock.release()
+            return
+        self._queued = self._queued + len(frames)
+        self._queue.append((frames, flags, timestamp))
+        self._lock.release()
+        self._wakeup.set()
+
+    def stop(self):
+        self._abort = 1
+        self._wakeup.set()
+        self.join()
+
+    def run(self):
+        try:
+            self.__record()
+        except EnvironmentError, e:
+            self._lock.acquire()
+            self.error = str(e)
+            # the frames queued are lost too
+            self.dropped = self.dropped + self._queued
+            self._queue.clear()
+            self._queued = 0
+            self._lock.release()
+            try:
+                self.__close()
+            except EnvironmentError:
+                pass
+
+    def __record(self):
+        self.__open()
+        lastSync = time.time()
+        try:
+            while 1:
+                self._wakeup.wait(self._syncInterval)
+                self._wakeup.clear()
+                self.__write_queued()
+
+                now = time.time()
+                if (self._maxBytes > 0 and self._size >= self._maxBytes) or \
+                   (self._maxSeconds > 0 and now - self._opened >= self._maxSeconds):
+                    self.__close()
+                    self.__open()
+                    lastSync = now
+                elif now - lastSync >= self._syncInterval:
+                    self.__sync()
+                    lastSync = now
+
+                if self._abort:
+                    break
+        finally:
+            self.__write_queued()
+            self.__close()
+
+    def __write_queued(self):
+        queue = self._queue
+        while queue:
+            self._lock.acquire()
+            frames, flags, timestamp = queue.popleft()
+            self._queued = self._queued - len(frames)
+            self._lock.release()
+            try:
+                self._file.write(pack_frames(frames, flags, timestamp))
+            except EnvironmentError:
+                self._lock.acquire()
+                self.dropped = self.dropped + len(frames)
+                self._lock.release()
+                raise
+            self._size = self._size + RECORD.size * len(frames)
+            self.records = self.records + len(frames)
+
+    def __open(self):
+        if self.files:
+            root, ext = os.path.splitext(self._path)
+            path = "%s.%d%s" % (root, len(self.files), ext)
+        else:
+            path = self._path
+        self._file = open(path, 'wb', self.BUFFER_SIZE)
+        write_header(self._file)
+        self._size = HEADER.size
+        self._opened = time.time()
+        self.files.append(path)
+
+    def __sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __close(self):
+        if self._file:
+            f = self._file
+            self._file = None
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+
+INDEX_MAGIC = 'CANIDX'
+INDEX_HEADER = struct.Struct('<6sHIIdI')  # magic, version, step, records, first timestamp, IDs
+INDEX_ID = struct.Struct('<II')           # key, number of records
+
+
+def id_key(msg_id, xtd):
+    return msg_id | (xtd << 31)
+
+
+class CaptureReader(object):
+    """Read-only view of a capture file.
+
+    The file is memory-mapped and frames are only decoded when asked for,
+    with the same GetFrame()/GetTotalFrameCount()/GetFrameCount()/
+    GetFirstFrameIndex() interface as CANController.CANUSBController, so
+    a capture can be shown wherever live frames are.
+
+    Two indexes are built on the first open and kept in path + '.idx':
+    the highest timestamp seen every INDEX_STEP records, to find the
+    frames around a given time by binary search, and for each ID the
+    sorted list of its record numbers. The index is extended if the
+    capture has grown since it was saved. Without buildIndex, e.g. to
+    read the frames in order, only GetFrame() and the counts are
+    available.
+    """
+    INDEX_STEP = 1024
+
+    def __init__(self, path, useIndexFile=True, buildIndex=True):
+        self._path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            raise IOError("%s is not a capture file" % path)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, recordSize, reserved = HEADER.unpack_from(self._map)
+        if magic != MAGIC or recordSize != RECORD.size:
+            self.Close()
+            raise IOError("%s is not a capture file" % path)
+        self._count = (size - HEADER.size) // RECORD.size
+
+        self._times = array.array('d')   # running max timestamp every INDEX_STEP records
+        self._ids = {}                   # id_key -> array of record numbers
+        self._indexed = 0
+        self._indexPath = path + '.idx'
+        if not buildIndex:
+            return
+        if useIndexFile:
+            self.__load_index()
+        if self._indexed < self._count:
+            self.__build_index()
+            if useIndexFile:
+                self.__save_index()
+
+    def Close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def GetFrame(self, index):
+        if index < 0 or index >= self._count:
+            return None
+        return unpack_frame(self._map, HEADER.size + index * RECORD.size)[0]
+
+    # Returns FLAG_XTD, FLAG_RTR and FLAG_TX of the frame
+    def GetFrameFlags(self, index):
+        return ord(self._map[HEADER.size + index * RECORD.size + 12])
+
+    def GetTotalFrameCount(self):
+        return self._count
+
+    def GetFrameCount(self):
+        return self._count
+
+    def GetFirstFrameIndex(self):
+        return 0
+
+    # Returns (buffer, offset, count): the records are the count records
+    # at offset in buffer, e.g. to view them as a numpy array
+    def GetRecords(self):
+        return self._map, HEADER.size, self._count
+
+    # Returns (first, highest) timestamp, None for an empty capture
+    def GetTimeRange(self):
+        if not self._count:
+            return None
+        return (self.__timestamp(0), self._times[-1])
+
+    # Index of the first frame stamped at or after t, GetTotalFrameCount()
+    # if there is none. Timestamps only need to be roughly ordered, as
+    # with TX frames stamped on the host between hardware stamped frames.
+    def FindFrameAtTime(self, t):
+        block = bisect.bisect_left(self._times, t)
+        if block >= len(self._times):
+            return self._count
+        index = block * self.INDEX_STEP
+        end = min(index + self.INDEX_STEP, self._count)
+        while index < end and self.__timestamp(index) < t:
+            index = index + 1
+        return index
+
+    # Returns [(msg_id, xtd, number of frames)]
+    def GetIDs(self):
+        return [(key & 0x7fffffff, key >> 31, len(records)) for key, records in self._ids.iteritems()]
+
+    # Sorted array of the indexes of the frames with the given ID
+    def GetFramesOfID(self, msg_id, xtd=0):
+        return self._ids.get(id_key(msg_id, xtd), array.array('I'))
+
+    # Index of the next frame with the given ID after index, None if
+    # there is none
+    def FindNextFrameOfID(self, msg_id, xtd, index):
+        records = self.GetFramesOfID(msg_id, xtd)
+        i = bisect.bisect_right(records, index)
+        if i < len(records):
+            return records[i]
+        return None
+
+    # Index of the previous frame with the given ID before index, None if
+    # there is none
+    def FindPrevFrameOfID(self, msg_id, xtd, index):
+        records = self.GetFramesOfID(msg_id, xtd)
+        i = bisect.bisect_left(records, index)
+        if i > 0:
+            return records[i-1]
+        return None
+
+    def __timestamp(self, index):
+        return TIMESTAMP.unpack_from(self._map, HEADER.size + index * RECORD.size)[0]
+
+    def __build_index(self):
+        step = self.INDEX_STEP
+        times = self._times
+        ids = self._ids
+        unpack_from = INDEX_FIELDS.unpack_from
+        buf = self._map
+        if times:
+            tmax = times[-1]
+        else:
+            tmax = float('-inf')
+        index = self._indexed
+        offset = HEADER.size + index * RECORD.size
+        while index < self._count:
+            ts, msg_id, flags = unpack_from(buf, offset)
+            if ts > tmax:
+                tmax = ts
+            key = msg_id | ((flags & FLAG_XTD) << 31)
+            records = ids.get(key)
+            if records is None:
+                records = ids[key] = array.array('I')
+            records.append(index)
+            index = index + 1
+            offset = offset + RECORD.size
+            if index % step == 0 or index == self._count:
+                # the last block is replaced when the capture grows
+                block = (index - 1) // step
+                if block < len(times):
+                    times[block] = tmax
+                else:
+                    times.append(tmax)
+        self._indexed = index
+
+    def __load_index(self):
+        try:
+            f = open(self._indexPath, 'rb')
+        except IOError:
+            return False
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            magic, version, step, records, first, nIDs = INDEX_HEADER.unpack_from(data)
+        except struct.error:
+            return False
+        if magic != INDEX_MAGIC or version != VERSION or step != self.INDEX_STEP or \
+           records > self._count or (records and first != self.__timestamp(0)):
+            # stale index of another capture
+            return False
+        offset = INDEX_HEADER.size
+        nBlocks = (records + step - 1) // step
+        times = array.array('d')
+        ids = {}
+        total = 0
+        try:
+            times.fromstring(data[offset:offset + 8 * nBlocks])
+            offset = offset + 8 * nBlocks
+            for i in xrange(nIDs):
+                key, n = INDEX_ID.unpack_from(data, offset)
+                offset = offset + INDEX_ID.size
+                ids[key] = array.array('I')
+                ids[key].fromstring(data[offset:offset + 4 * n])
+                offset = offset + 4 * n
+                if len(ids[key]) != n:
+                    return False
+                total = total + n
+        except (ValueError, struct.error):
+            # truncated index
+            return False
+        if len(times) != nBlocks or total != records or offset != len(data):
+            return False
+        self._times = times
+        self._ids = ids
+        self._indexed = records
+        return True
+
+    def __save_index(self):
+        if self._count:
+            first = self.__timestamp(0)
+        else:
+            first = 0.0
+        # written aside and renamed so that a crash or a full disk never
+        # leaves a partial index
+        tmpPath = self._indexPath + '.tmp'
+        try:
+            f = open(tmpPath, 'wb')
+        except IOError:
+            # read-only location, the index is rebuilt next time
+            return
+        try:
+            try:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, self.INDEX_STEP, self._indexed,
+                                          first, len(self._ids)))
+                f.write(self._times.tostring())
+                for key, records in self._ids.iteritems():
+                    f.write(INDEX_ID.pack(key, len(records)))
+                    f.write(records.tostring())
+            finally:
+                f.close()
+            try:
+                os.rename(tmpPath, self._indexPath)
+            except OSError:
+                # Windows does not replace an existing file
+                os.remove(self._indexPath)
+                os.rename(tmpPath, self._indexPath)
+        except EnvironmentError:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
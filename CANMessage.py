@@ -9,20 +9,23 @@ import math
 import time
 
 class CANFrame(object):
-    def __init__(self, msg_id=0, xtd=0, rtr=0, ndata=0, data=() ):
+    def __init__(self, msg_id=0, xtd=0, rtr=0, ndata=0, data=(), timestamp=None):
         """
         msg_id -- Message ID (11 Bit or 29 Bit)
         xtd -- Extended 
         rtr -- Remote Transmission Request
         ndata -- Number of data bytes (0..8)
         data -- Sequence of ndata bytes
+        timestamp -- Time the frame was received, defaults to now
         """
         self.msg_id = msg_id
         self.rtr = rtr
         self.xtd = xtd
         self.ndata = ndata
         self.data = data # tuple with length 0..8
-        self.timestamp = time.time()  # Timestamp of object creation
+        if timestamp is None:
+            timestamp = time.time()  # Timestamp of object creation
+        self.timestamp = timestamp
         
     def __str__(self):
         printdata = tuple(map(hex, self.data))
@@ -50,7 +53,14 @@ class CANFrame(object):
     
 
 class CANSignal(object):
-    def __init__(self, name, id=0, xtd=0, dtype='u8', endian='intel', startbit=0, bitlength=32, val=0.0 ):
+    # mux value of the signal selecting the multiplexed signals of a message
+    MULTIPLEXOR = 'M'
+
+    # compiled SignalCodec, None until the signal is first converted
+    _codec = None
+    _mux = None
+
+    def __init__(self, name, id=0, xtd=0, dtype='u8', endian='intel', startbit=0, bitlength=32, val=0.0, mux=None ):
         """
         name -- Signal name
         id -- Signal arbitration ID (11 Bit or 29 Bit)
@@ -60,6 +70,9 @@ class CANSignal(object):
         startbit -- LSB position in the CAN frame payload
         bitlength -- Number of bits occupied by the signal
         val -- Signal value
+        mux -- None for a signal always present in its message, MULTIPLEXOR
+               for the multiplexor of the message, or the multiplexor value
+               for which the signal is present
         """
         self._name = name
         self._id = id
@@ -69,7 +82,14 @@ class CANSignal(object):
         self._startbit = startbit
         self._bitlength = bitlength
         self._val = val
-        
+        self._mux = mux
+
+    def __getstate__(self):
+        # the codec is rebuilt from the definition when needed
+        state = self.__dict__.copy()
+        state.pop('_codec', None)
+        return state
+
     def get_id(self):
         return self._id
     
@@ -95,20 +115,136 @@ class CANSignal(object):
         #if not hasattr(self, "_val"):
         #    self._val = 0.0
         return self._val
+
+    def get_mux(self):
+        return self._mux
+
+    def set_id(self, id):
+        self._id = id
+
+    def set_xtd(self, xtd):
+        self._xtd = xtd
+
+    def set_endian(self, endian):
+        self._endian = endian
+        self._codec = None
+
+    def set_dtype(self, dtype):
+        self._dtype = dtype
+        self._codec = None
+
+    def set_startbit(self, startbit):
+        self._startbit = startbit
+        self._codec = None
+
+    def set_bitlength(self, bitlength):
+        self._bitlength = bitlength
+        self._codec = None
+
+    def set_name(self, name):
+        self._name = name
+
+    def set_val(self, val):
+        self._val = val
+
+    def set_mux(self, mux):
+        self._mux = mux
+
+    def get_codec(self):
+        codec = self._codec
+        if codec is None:
+            codec = self._codec = GetSignalCodec(self._dtype, self._endian, self._startbit, self._bitlength)
+        return codec
     
     def to_canframe(self):
-        bytes = ValueToRawData(self._dtype, self._endian, self._startbit, self._bitlength, self._val)   
-        data = tuple([b for b in bytes])
+        data = self.get_codec().encode(self._val)
         ndata = 8
         
         return CANFrame(self._id, self._xtd, 0, ndata, data)
     
     def from_canframe(self, frame):
-        data = bytearray(frame.get_data())
-        self._val = RawDataToValue(self._dtype, self._endian, self._startbit, self._bitlength, data)
+        self._val = self.get_codec().decode(frame.get_data())
         
         return self._val
 
+class CANMessageDef(object):
+    """The signals sent in the frames of one arbitration ID.
+
+    A message can be multiplexed: its multiplexor signal (mux set to
+    CANSignal.MULTIPLEXOR) tells which of the signals with a mux value are
+    present in a frame, the signals without mux value always are. The
+    payload of a frame is unpacked once and every signal is extracted
+    from it with its codec.
+    """
+    def __init__(self, name, id=0, xtd=0, signals=()):
+        self._name = name
+        self._id = id
+        self._xtd = xtd
+        self._signals = []
+        self._multiplexor = None
+        for sig in signals:
+            self.add_signal(sig)
+
+    def get_name(self):
+        return self._name
+
+    def get_id(self):
+        return self._id
+
+    def get_xtd(self):
+        return self._xtd
+
+    def get_signals(self):
+        return self._signals
+
+    def get_multiplexor(self):
+        return self._multiplexor
+
+    def add_signal(self, sig):
+        if sig.get_mux() == CANSignal.MULTIPLEXOR:
+            self._multiplexor = sig
+        self._signals.append(sig)
+
+    def remove_signal(self, sig):
+        self._signals.remove(sig)
+        if sig is self._multiplexor:
+            self._multiplexor = None
+
+    def get_present_signals(self, muxValue=None):
+        """Signals present in a frame with the given multiplexor value"""
+        return [sig for sig in self._signals if sig.get_mux() in (None, CANSignal.MULTIPLEXOR, muxValue)]
+
+    def decode(self, frame):
+        """Return [(signal, value)] of the signals present in the frame"""
+        payload = PAYLOAD.unpack(PAYLOAD_BYTES.pack(*frame.get_data()))[0]
+        multiplexor = self._multiplexor
+        if multiplexor is None:
+            return [(sig, sig.get_codec().decode_payload(payload)) for sig in self._signals]
+        muxValue = multiplexor.get_codec().decode_payload(payload)
+        values = []
+        for sig in self._signals:
+            mux = sig.get_mux()
+            if sig is multiplexor:
+                values.append((sig, muxValue))
+            elif mux is None or mux == muxValue:
+                values.append((sig, sig.get_codec().decode_payload(payload)))
+        return values
+
+    def to_canframe(self, muxValue=None):
+        """Frame holding the values of the signals present for the given
+        multiplexor value, or for the value of the multiplexor signal"""
+        multiplexor = self._multiplexor
+        if multiplexor is not None and muxValue is None:
+            muxValue = multiplexor.get_val()
+        data = [0] * 8
+        for sig in self.get_present_signals(muxValue):
+            if sig is multiplexor:
+                value = muxValue
+            else:
+                value = sig.get_val()
+            data = [a | b for a, b in zip(data, sig.get_codec().encode(value))]
+        return CANFrame(self._id, self._xtd, 0, 8, tuple(data))
+
 def GetDataTypeSize(dataType):
     if dataType == "bit":
         return 1
@@ -141,164 +277,109 @@ def GetDataTypeSize(dataType):
 # the logical byte order is reversed or "backwards "when compared to Motorola Forwards
 #  Bit Progression from start bit: BitwiseLeft,Bytewise Left
 def ValueToRawData(dataType, endian, startBit, bitLength, value):
-        
-    if dataType == "bit":
-        if value > 0.0:
-            bytes = struct.pack("BBBBBBBB", 1, 0, 0, 0, 0, 0, 0, 0)
-        else:
-            bytes = struct.pack("BBBBBBBB", 0, 0, 0, 0, 0, 0, 0, 0)
-    elif dataType == "u8":
-        bytes = struct.pack("BBBBBBBB", int(math.floor(value+0.5))&0xFF, 0, 0, 0, 0, 0, 0, 0)
-    elif dataType == "i8":
-        bytes = struct.pack("bbbbbbbb", int(math.floor(value+0.5)), 0, 0, 0, 0, 0, 0, 0)
-    elif dataType == "u16":       
-        if endian == "motorola":
-            bytes = struct.pack(">HHHH", int(math.floor(value+0.5))&0xFFFF, 0, 0, 0)          
-        else:
-            bytes = struct.pack("<HHHH", int(math.floor(value+0.5))&0xFFFF, 0, 0, 0)        
-    elif dataType == "i16":       
-        if endian == "motorola":
-            bytes = struct.pack(">hhhh", int(math.floor(value+0.5)), 0, 0, 0)            
-        else:
-            bytes = struct.pack("<hhhh", int(math.floor(value+0.5)), 0, 0, 0)        
-    elif dataType == "u32":       
-        if endian == "motorola":
-            bytes = struct.pack(">II", int(math.floor(value+0.5))&0xFFFFFFFF, 0)              
-        else:
-            bytes = struct.pack("<II", int(math.floor(value+0.5))&0xFFFFFFFF, 0)        
-    elif dataType == "i32":       
-        if endian == "motorola":
-            bytes = struct.pack(">ii", int(math.floor(value+0.5)), 0)              
-        else:
-            bytes = struct.pack("<ii", int(math.floor(value+0.5)), 0)        
-    elif dataType == "u64":       
-        if endian == "motorola":
-            bytes = struct.pack(">Q", int(math.floor(value+0.5)))              
-        else:
-            bytes = struct.pack("<Q", int(math.floor(value+0.5)))        
-    elif dataType == "i64":       
-        if endian == "motorola":
-            bytes = struct.pack(">q", int(math.floor(value+0.5)))              
-        else:
-            bytes = struct.pack("<q", int(math.floor(value+0.5)))        
-    elif dataType == "f32":       
-        if endian == "motorola":
-            bytes = struct.pack(">fi", value, 0)              
-        else:
-            bytes = struct.pack("<fi", value, 0)      
-    elif dataType == "f64":        
-        if endian == "motorola":
-            bytes = struct.pack(">d", value)              
-        else:
-            bytes = struct.pack("<d", value)      
-    
-    tmp = struct.unpack("Q", bytes)[0]
-     
-    # shift converted data
-    # We only support the "Motorola Forward case which is the one used in 
-    # Candb++ databases (older Candb databases use Motorola Backward)
-    lsbShift = 0
-    if endian == "motorola":
-        # add offset to original shift so that lsb of converted value
-        # is at bit 0
-        lsbShift = 8 - GetDataTypeSize(dataType)
-    
-    startBit = startBit + lsbShift    
-    
-    if startBit+bitLength > 64:
-        bitLength = 64 - startBit
-   
-    if startBit < 0:
-        mask = ((1L<<bitLength)-1) >> -startBit   
-        tmp = (tmp >> -startBit) & mask
-    else:
-        mask = ((1L<<bitLength)-1) << startBit   
-        tmp = (tmp << startBit) & mask
-    
-    bytes = struct.pack("Q", tmp)
-    
-    ret = []
-    for byte in array.array('B', bytes):
-        ret.append(byte)
-        
-    return ret
+    return list(GetSignalCodec(dataType, endian, startBit, bitLength).encode(value))
 
 def RawDataToValue(dataType, endian, startBit, bitLength, rawBytes):
-    bytes = array.array('B', rawBytes)
+    return GetSignalCodec(dataType, endian, startBit, bitLength).decode(array.array('B', rawBytes))
 
-    tmp = struct.unpack("Q", bytes)[0]
-    
-    # shift converted data
-    # We only support the "Motorola Forward case which is the one used in 
-    # Candb++ databases (older Candb databases use Motorola Backward)
-    lsbShift = 0
-    if endian == "motorola":
-        # add offset to original shift so that lsb of converted value
-        # is at bit 0
-        lsbShift = 8 - GetDataTypeSize(dataType)
-    
-    startBit = startBit + lsbShift    
-    
-    if startBit < 0:
-        mask = ((1L<<bitLength)-1) >> -startBit
-        tmp = (tmp & mask) << -startBit
-    else:
-        mask = ((1L<<bitLength)-1) << startBit
-        tmp = (tmp & mask) >> startBit
-    
-    bytes = struct.pack("Q", tmp)
-    
-    if dataType == "bit":
-        if tmp > 0:
-            retval = 1
-        else:
-            retval = 0
-    elif dataType == "u8":
-        retval = struct.unpack("BBBBBBBB", bytes)[0]
-    elif dataType == "i8":
-        retval = struct.unpack("bbbbbbbb", bytes)[0]
-    elif dataType == "u16":       
-        if endian == "motorola":
-            retval = struct.unpack(">HHHH", bytes)[0]              
-        else:
-            retval = struct.unpack("<HHHH", bytes)[0]  
-    elif dataType == "i16":       
-        if endian == "motorola":
-            retval = struct.unpack(">hhhh", bytes)[0]              
-        else:
-            retval = struct.unpack("<hhhh", bytes)[0]             
-    elif dataType == "u32":       
-        if endian == "motorola":
-            retval = struct.unpack(">II", bytes)[0]         
-        else:
-            retval = struct.unpack("<II", bytes)[0]  
-    elif dataType == "i32":       
-        if endian == "motorola":
-            retval = struct.unpack(">ii", bytes)[0]         
-        else:
-            retval = struct.unpack("<ii", bytes)[0]     
-    elif dataType == "u64":       
+
+# The payload as the 64 bit integer the signals are extracted from
+PAYLOAD = struct.Struct("Q")
+PAYLOAD_BYTES = struct.Struct("BBBBBBBB")
+
+# dataType -> (struct format of the little and big endian value packed in
+# 8 bytes, function preparing the value to pack)
+def _round(value):
+    return int(math.floor(value+0.5))
+
+SIGNAL_FORMATS = {
+    "bit": ("BBBBBBBB", "BBBBBBBB", lambda value: (value > 0.0 and 1 or 0, 0, 0, 0, 0, 0, 0, 0)),
+    "u8":  ("BBBBBBBB", "BBBBBBBB", lambda value: (_round(value)&0xFF, 0, 0, 0, 0, 0, 0, 0)),
+    "i8":  ("bbbbbbbb", "bbbbbbbb", lambda value: (_round(value), 0, 0, 0, 0, 0, 0, 0)),
+    "u16": ("<HHHH", ">HHHH", lambda value: (_round(value)&0xFFFF, 0, 0, 0)),
+    "i16": ("<hhhh", ">hhhh", lambda value: (_round(value), 0, 0, 0)),
+    "u32": ("<II", ">II", lambda value: (_round(value)&0xFFFFFFFF, 0)),
+    "i32": ("<ii", ">ii", lambda value: (_round(value), 0)),
+    "u64": ("<Q", ">Q", lambda value: (_round(value),)),
+    "i64": ("<q", ">q", lambda value: (_round(value),)),
+    "f32": ("<fi", ">fi", lambda value: (value, 0)),
+    "f64": ("<d", ">d", lambda value: (value,)),
+}
+
+class SignalCodec(object):
+    """Decoder and encoder of one signal layout.
+
+    The payload is read as a native 64 bit integer, the signal bits are
+    (payload & mask) >> shift, or << -shift for a negative shift, and the
+    value is converted with a precompiled struct for its type. Use
+    GetSignalCodec() to share codecs between signals.
+    """
+    def __init__(self, dataType, endian, startBit, bitLength):
+        if dataType not in SIGNAL_FORMATS:
+            raise ValueError("Unknown signal data type %r" % (dataType,))
+        intelFormat, motorolaFormat, prepare = SIGNAL_FORMATS[dataType]
+        # We only support the "Motorola Forward case which is the one used in 
+        # Candb++ databases (older Candb databases use Motorola Backward)
         if endian == "motorola":
-            retval = struct.unpack(">Q", bytes)[0]            
+            # add offset to original shift so that lsb of converted value
+            # is at bit 0
+            startBit = startBit + 8 - GetDataTypeSize(dataType)
+            fmt = struct.Struct(motorolaFormat)
         else:
-            retval = struct.unpack("<Q", bytes)[0]   
-    elif dataType == "i64":       
-        if endian == "motorola":
-            retval = struct.unpack(">q", bytes)[0]            
+            fmt = struct.Struct(intelFormat)
+        self.dataType = dataType
+        self.endian = endian
+        self._bit = dataType == "bit"
+        self._fmt = fmt
+        self._prepare = prepare
+        self.shift = startBit
+        self.mask = ((1L<<bitLength)-1) << max(startBit, 0) >> max(-startBit, 0)
+        # the encoder drops the bits past the end of the payload
+        if startBit+bitLength > 64:
+            bitLength = 64 - startBit
+        if bitLength < 0:
+            self._encodeMask = None
         else:
-            retval = struct.unpack("<q", bytes)[0]        
-    elif dataType == "f32":       
-        if endian == "motorola":
-            retval = struct.unpack(">fi", bytes)[0]              
+            self._encodeMask = ((1L<<bitLength)-1) << max(startBit, 0) >> max(-startBit, 0)
+
+    def decode(self, data):
+        """Value of the signal in the 8 bytes of data"""
+        return self.decode_payload(PAYLOAD.unpack(PAYLOAD_BYTES.pack(*data))[0])
+
+    def decode_payload(self, payload):
+        """Value of the signal in the payload read as a native 64 bit
+        integer, e.g. to decode several signals of a frame"""
+        shift = self.shift
+        if shift < 0:
+            tmp = (payload & self.mask) << -shift
         else:
-            retval = struct.unpack("<fi", bytes)[0]   
-    elif dataType == "f64":        
-        if endian == "motorola":
-            retval = struct.unpack(">d", bytes)[0]              
+            tmp = (payload & self.mask) >> shift
+        if self._bit:
+            if tmp > 0:
+                return 1
+            return 0
+        return self._fmt.unpack(PAYLOAD.pack(tmp))[0]
+
+    def encode(self, value):
+        """Tuple of the 8 payload bytes holding the value"""
+        if self._encodeMask is None:
+            raise ValueError("Signal starts past the end of the payload")
+        tmp = PAYLOAD.unpack(self._fmt.pack(*self._prepare(value)))[0]
+        shift = self.shift
+        if shift < 0:
+            tmp = (tmp >> -shift) & self._encodeMask
         else:
-            retval = struct.unpack("<d", bytes)[0]      
+            tmp = (tmp << shift) & self._encodeMask
+        return PAYLOAD_BYTES.unpack(PAYLOAD.pack(tmp))
+
+_signalCodecs = {}
 
-    return retval
+def GetSignalCodec(dataType, endian, startBit, bitLength):
+    key = (dataType, endian, startBit, bitLength)
+    codec = _signalCodecs.get(key)
+    if codec is None:
+        codec = _signalCodecs[key] = SignalCodec(dataType, endian, startBit, bitLength)
+    return codec
 
 
 if __name__ == "__main__": 
@@ -0,0 +1,276 @@
+'''
+Acquisition in a child process
+
+The child process owns the serial port: it reads and parses the dongle
+output and transmits frames without competing with the GUI for the
+interpreter lock. Received frames are written as CANLog records into a
+ring in shared memory, which the parent decodes in place. Commands,
+transmit results and status responses go through a pipe.
+
+ProcessLink offers the subset of lawicel_canusb.CanUSB that
+CANController.WorkerThread uses, so the worker runs unchanged on top of
+it.
+'''
+import ctypes
+import multiprocessing
+import time
+from collections import deque
+import lawicel_canusb
+import CANLog
+import CANMessage
+
+# Frames held by the shared ring
+RING_CAPACITY = 65536
+
+# Longest time the child waits for serial data before checking for
+# commands from the parent
+CHILD_POLL_TIMEOUT = 0.005
+
+# Counters shared by the child
+BYTES_READ = 0
+PARSER_DROPPED = 1
+TX_FAILED = 2
+NUM_COUNTERS = 3
+
+
+class FrameRing(object):
+    """Ring of CANLog records in shared memory, one writer and one reader.
+
+    Like a seqlock, the writer first advances the claimed counter to the
+    end of the records it is about to copy, then copies them and finally
+    advances the written counter, the total number of frames ever
+    written. The reader decodes up to the written counter and then reads
+    the claimed counter: records the writer has overwritten or may be
+    overwriting, including by a copy still in progress, are counted as
+    lost instead of returned.
+    """
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self._buf = multiprocessing.RawArray(ctypes.c_char, capacity * CANLog.RECORD.size)
+        self._written = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._claimed = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._read = 0
+        self.lost = 0   # frames overwritten before the reader got them
+
+    def write(self, frames):
+        size = CANLog.RECORD.size
+        written = self._written.value
+        if len(frames) > self.capacity:
+            # the reader counts the frames skipped as lost
+            written = written + len(frames) - self.capacity
+            frames = frames[-self.capacity:]
+        data = CANLog.pack_frames(frames)
+        self._claimed.value = written + len(frames)
+        start = (written % self.capacity) * size
+        first = min(len(data), len(self._buf) - start)
+        self._buf[start:start + first] = data[:first]
+        if first < len(data):
+            self._buf[0:len(data) - first] = data[first:]
+        self._written.value = written + len(frames)
+
+    def available(self):
+        return self._written.value - self._read
+
+    def read(self):
+        """Return the frames written since the last call"""
+        end = self._written.value
+        start = self._read
+        if end - start > self.capacity:
+            self.lost = self.lost + end - start - self.capacity
+            start = end - self.capacity
+        size = CANLog.RECORD.size
+        unpack_frame = CANLog.unpack_frame
+        buf = self._buf
+        capacity = self.capacity
+        frames = [unpack_frame(buf, (seq % capacity) * size)[0] for seq in xrange(start, end)]
+        # any record below claimed - capacity may have been overwritten
+        # while it was decoded
+        overwritten = min(self._claimed.value - capacity - start, end - start)
+        if overwritten > 0:
+            self.lost = self.lost + overwritten
+            frames = frames[overwritten:]
+        self._read = end
+        return frames
+
+
+def acquire(device, bitrate, timestamps, accCode, accMask, ring, counters, conn):
+    """Main function of the child process"""
+    try:
+        canusb = lawicel_canusb.opencan(device, bitrate, timestamps, accCode, accMask)
+    except Exception, e:
+        conn.send(('error', str(e)))
+        return
+    conn.send(('ready',))
+
+    # frames received from the parent without a result sent back yet,
+    # the parent matches the results with its frames by their order
+    outstanding = 0
+    try:
+        while 1:
+            try:
+                while conn.poll():
+                    cmd = conn.recv()
+                    if cmd[0] == 'tx':
+                        outstanding = outstanding + len(cmd[1])
+                        # reports every frame, failed if not sent on timeout
+                        canusb.queue_frames([CANMessage.CANFrame(*f) for f in cmd[1]])
+                    elif cmd[0] == 'filter':
+                        canusb.close_channel()
+                        canusb.set_acc_code(cmd[1])
+                        canusb.set_acc_mask(cmd[2])
+                        canusb.open_channel()
+                    elif cmd[0] == 'status':
+                        conn.send(('status', canusb.get_status_flags()))
+                    elif cmd[0] == 'stop':
+                        canusb.close_channel()
+                        return
+                canusb.poll(CHILD_POLL_TIMEOUT)
+            except lawicel_canusb.CANUSBError, e:
+                # frames not acked on timeout are reported as failed below
+                if str(e).find("timeout") < 0:
+                    raise
+
+            frames = canusb.get_rx_frames()
+            if frames:
+                ring.write(frames)
+                # wakes the parent up
+                conn.send(('rx',))
+            results = canusb.get_tx_results()
+            if results:
+                conn.send(('tx', [ok for f, ok in results]))
+                outstanding = outstanding - len(results)
+            counters[BYTES_READ] = canusb.bytes_read
+            counters[PARSER_DROPPED] = canusb.get_parser_dropped()
+            counters[TX_FAILED] = canusb.tx_failed
+    except Exception, e:
+        # the frames still in flight or not sent at all have failed, the
+        # results come first as they belong to the oldest frames
+        oks = [ok for f, ok in canusb.get_tx_results()]
+        conn.send(('tx', oks + [False] * (outstanding - len(oks))))
+        conn.send(('error', str(e)))
+
+
+class ProcessLink(object):
+    """Stands in for lawicel_canusb.CanUSB with the dongle driven by a
+    child process. Errors in the child are raised as CANUSBError by the
+    next call.
+    """
+    def __init__(self, device, bitrate, timestamps=False, accCode=None, accMask=None,
+                 capacity=RING_CAPACITY):
+        self._ring = FrameRing(capacity)
+        self._counters = multiprocessing.RawArray(ctypes.c_ulonglong, NUM_COUNTERS)
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=acquire,
+                                                args=(device, bitrate, timestamps, accCode, accMask,
+                                                      self._ring, self._counters, child))
+        self._process.daemon = True
+        self._process.start()
+        self._tx_pending = deque()
+        self._tx_results = deque(maxlen=lawicel_canusb.TX_RESULTS_LEN)
+        self._status = None
+        self._acc_code = accCode
+        self._acc_mask = accMask
+
+        msg = self.__recv(lawicel_canusb.SERIAL_TIMEOUT * 10)
+        if msg is None or msg[0] != 'ready':
+            self.close()
+            if msg is None:
+                raise lawicel_canusb.CANUSBError('acquisition process did not start (timeout)')
+            raise lawicel_canusb.CANUSBError(msg[1])
+
+    def __recv(self, timeout):
+        if not self._conn.poll(timeout):
+            return None
+        return self._conn.recv()
+
+    def __handle(self, msg):
+        if msg[0] == 'tx':
+            # the child sends exactly one result per frame, in order
+            for ok in msg[1]:
+                self._tx_results.append((self._tx_pending.popleft(), ok))
+        elif msg[0] == 'status':
+            self._status = msg[1]
+        elif msg[0] == 'error':
+            raise lawicel_canusb.CANUSBError(msg[1])
+
+    def __drain(self):
+        while self._conn.poll():
+            self.__handle(self._conn.recv())
+
+    @property
+    def bytes_read(self):
+        return self._counters[BYTES_READ]
+
+    @property
+    def tx_failed(self):
+        return self._counters[TX_FAILED]
+
+    @property
+    def ring_lost(self):
+        return self._ring.lost
+
+    def poll(self, timeout=lawicel_canusb.SERIAL_TIMEOUT):
+        if not self._ring.available():
+            msg = self.__recv(timeout)
+            if msg is None:
+                raise lawicel_canusb.CANUSBError('ser.read returned None (timeout)')
+            self.__handle(msg)
+        self.__drain()
+        return []
+
+    def get_rx_frames(self):
+        return self._ring.read()
+
+    def queue_frames(self, frames):
+        if not frames:
+            return
+        self._conn.send(('tx', [(f.msg_id, f.xtd, f.rtr, f.ndata, tuple(f.data)) for f in frames]))
+        self._tx_pending.extend(frames)
+
+    def get_tx_results(self):
+        self.__drain()
+        results = list(self._tx_results)
+        self._tx_results.clear()
+        return results
+
+    def get_tx_pending(self):
+        return len(self._tx_pending)
+
+    def get_parser_dropped(self):
+        return self._counters[PARSER_DROPPED]
+
+    def get_status_flags(self):
+        self._status = None
+        self._conn.send(('status',))
+        deadline = time.time() + lawicel_canusb.SERIAL_TIMEOUT
+        while self._status is None:
+            msg = self.__recv(max(deadline - time.time(), 0))
+            if msg is None:
+                raise lawicel_canusb.CANUSBError('ser.read returned None (timeout)')
+            self.__handle(msg)
+        return self._status
+
+    # The acceptance filter is sent to the child when the channel is
+    # reopened, which closes and reopens the real channel.
+    def close_channel(self):
+        pass
+
+    def set_acc_code(self, code):
+        self._acc_code = code
+
+    def set_acc_mask(self, mask):
+        self._acc_mask = mask
+
+    def open_channel(self):
+        self._conn.send(('filter', self._acc_code, self._acc_mask))
+
+    def close(self):
+        """Close the channel and stop the child process"""
+        if self._process.is_alive():
+            try:
+                self._conn.send(('stop',))
+            except IOError:
+                pass
+            self._process.join(lawicel_canusb.SERIAL_TIMEOUT * 2)
+            if self._process.is_alive():
+                self._process.terminate()
@@ -47,6 +47,9 @@ class FrameList(wx.ListCtrl):
             f = self.parent.GetLastCANFrameByID(item)
         else:
             f = self.parent.GetCANFrame(item)
+        if f == None:
+            # frame overwritten since the item count was updated
+            return ""
             
         if 0 == col:
             return "%d" % item
@@ -63,12 +66,11 @@ class FrameList(wx.ListCtrl):
         elif 6 == col:
             return "0x%02x 0x%02x 0x%02x 0x%02x 0x%02x 0x%02x 0x%02x 0x%02x" % f.get_data()
         else:
-            # Find if there is a CAN signal for this id
-            sig = CANDatabase.candb.FindSignalById(f.get_msg_id())
-            if sig != None:
-                value = sig.from_canframe(f)
-                return str(value)
-            return ""
+            # Decode the signals of the message with this id, if any
+            values = CANDatabase.candb.DecodeFrame(f)
+            if len(values) == 1:
+                return str(values[0][1])
+            return ", ".join(["%s=%s" % (sig.get_name(), value) for sig, value in values])
             
 
     def OnGetItemImage(self, item):
@@ -93,7 +95,7 @@ class CANAnalyzerRxPanel(wx.Panel):
         self.receivedMsgs.InsertColumn(4, "RTR", width=20)
         self.receivedMsgs.InsertColumn(5, "Length", width=50)
         self.receivedMsgs.InsertColumn(6, "Bytes", width=300)
-        self.receivedMsgs.InsertColumn(7, "Value", width=200)
+        self.receivedMsgs.InsertColumn(7, "Values", width=300)
         
         self.receivedMsgs.Bind(wx.EVT_LIST_ITEM_SELECTED, self.OnItemSelected)
         self.receivedMsgs.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.OnItemActivated)
@@ -103,6 +105,11 @@ class CANAnalyzerRxPanel(wx.Panel):
         self.msgRateList.InsertColumn(0, "ID", width=100)
         self.msgRateList.InsertColumn(1, "Count", width=100)
         self.msgRateList.InsertColumn(2, "Rate (msg/s)", width=100)
+        self.msgRateList.InsertColumn(3, "Period (ms)", width=100)
+        self.msgRateList.InsertColumn(4, "Jitter (ms)", width=100)
+        self.msgRateList.InsertColumn(5, "Status", width=100)
+        
+        self.busLoad = wx.StaticText(self, label="Bus load:")
         
         self.clearButton = wx.Button(self, label="Clear")
         self.clearButton.Bind(wx.EVT_BUTTON, self.OnClear)
@@ -111,6 +118,7 @@ class CANAnalyzerRxPanel(wx.Panel):
         self.vbox.Add(self.ShowOneMessagePerID, flag=wx.CENTER|wx.ALL, border=5)
         self.vbox.Add(self.receivedMsgs, proportion=1, flag=wx.EXPAND|wx.ALL, border=5)
         self.vbox.Add(self.msgRateList, proportion=0, flag=wx.EXPAND|wx.ALL, border=5)
+        self.vbox.Add(self.busLoad, flag=wx.EXPAND|wx.ALL, border=5)
         self.vbox.Add(self.clearButton, flag=wx.CENTER|wx.ALL, border=5)
         
         self.SetSizer(self.vbox)   
@@ -119,11 +127,11 @@ class CANAnalyzerRxPanel(wx.Panel):
         EVT_FRAME(self, self.OnFrameReceived)   
         
         self.can = None
-        self.starttime = 0.0
+        self.statsVersion = 0
+        self.rateRows = {}
         
     def Start(self, can):
         self.can = can 
-        self.starttime = time.clock()
         
     def Stop(self):
         pass
@@ -136,33 +144,63 @@ class CANAnalyzerRxPanel(wx.Panel):
             # of frames to display. The list control is virtual
             # and will dynamically fetch the frames that are visible
             if self.receivedMsgs.GetOneFramePerID():
-                self.receivedMsgs.UpdateFrameCount(len(self.can.GetLastFramesByID()))
+                # Rows keep their position, only redraw the ones whose
+                # payload changed
+                numIDs = self.can.GetIDCount()
+                if numIDs != self.receivedMsgs.GetItemCount():
+                    self.receivedMsgs.SetItemCount(numIDs)
+                for row in self.can.GetChangedRows():
+                    self.receivedMsgs.RefreshItem(row)
             else:
-                self.receivedMsgs.UpdateFrameCount(event.data)
+                self.receivedMsgs.UpdateFrameCount(self.can.GetFrameCount())
             
-            # Update frame rate list with the latest frame counts
-            self.msgRateList.DeleteAllItems()
-            frameCounts = self.can.GetFrameCounts()
-            for id, count in frameCounts.items():
-                index = self.msgRateList.InsertStringItem(sys.maxint, "0x%08x" % id)
+            # Update frame rate list with the counts changed since
+            # the last refresh
+            self.statsVersion, changes, full = self.can.GetIDStatsSince(self.statsVersion)
+            if full:
+                self.ClearRateList()
+            for id, (count, f) in changes.items():
+                index = self.rateRows.get(id)
+                if index == None:
+                    index = self.msgRateList.InsertStringItem(sys.maxint, "0x%08x" % id)
+                    self.rateRows[id] = index
                 self.msgRateList.SetStringItem(index, 1, str(count))
-                rate = count/(time.clock()-self.starttime)
-                self.msgRateList.SetStringItem(index, 2, str(rate))
+            # Rates over the last second, so bursts and IDs that
+            # stopped show up
+            for id, timing in self.can.GetIDTiming().items():
+                index = self.rateRows.get(id)
+                if index == None:
+                    continue
+                count, rate, windowRate, minInterval, meanInterval, maxInterval, jitter, missing = timing
+                self.msgRateList.SetStringItem(index, 2, "%.1f" % windowRate)
+                self.msgRateList.SetStringItem(index, 3, "%.1f" % (meanInterval * 1000))
+                self.msgRateList.SetStringItem(index, 4, "%.2f" % (jitter * 1000))
+                if missing:
+                    self.msgRateList.SetStringItem(index, 5, "Missing")
+                else:
+                    self.msgRateList.SetStringItem(index, 5, "")
+            
+            load, peak, idLoads = self.can.GetBusLoad()
+            self.busLoad.SetLabel("Bus load: %.1f %% (peak %.1f %%)" % (load * 100, peak * 100))
+                
+    def ClearRateList(self):
+        self.msgRateList.DeleteAllItems()
+        self.rateRows = {}
                 
     def OnClear(self, event):
         self.can.ClearFrames()
         self.receivedMsgs.UpdateFrameCount(0)
         self.receivedMsgs.DeleteAllItems()
-        self.msgRateList.DeleteAllItems()
+        self.ClearRateList()
         
     def OnShowOneMessage(self, event):     
         if self.ShowOneMessagePerID.IsChecked():
             if(self.can):  
-                self.receivedMsgs.UpdateFrameCount(len(self.can.GetLastFramesByID()))
+                self.receivedMsgs.UpdateFrameCount(self.can.GetIDCount())
             self.receivedMsgs.SetOneFramePerID(True)
         else:
             if(self.can):  
-                self.receivedMsgs.UpdateFrameCount(self.can.GetTotalFrameCount())
+                self.receivedMsgs.UpdateFrameCount(self.can.GetFrameCount())
             self.receivedMsgs.SetOneFramePerID(False)
         
     def OnItemSelected(self, event):
@@ -175,9 +213,11 @@ class CANAnalyzerRxPanel(wx.Panel):
         pass
     
     def GetCANFrame(self, index):
-        return self.can.GetFrame(index)
+        # Only the most recent frames are kept, the list starts with
+        # the oldest one still in memory
+        return self.can.GetFrame(self.can.GetFirstFrameIndex() + index)
     
     def GetLastCANFrameByID(self, index):
-        return self.can.GetLastFramesByID().values()[index]
+        return self.can.GetLastFrameByRow(index)
         
             
@@ -0,0 +1,279 @@
+'''
+Live frame streaming over TCP
+
+FrameServer streams the frames received by a CANUSBController to any
+number of TCP clients and transmits the frames they send. Every packet
+is a 4 byte little endian length, then a type byte and the body:
+
+    FRAMES    server -> client  CANLog records of the frames received
+    TRANSMIT  client -> server  CANLog records of frames to send, the
+                                timestamps are ignored. A packet with an
+                                invalid frame is answered with an ERROR
+                                and none of its frames are sent
+    FILTER    client -> server  CANFilter expression selecting the frames
+                                the client gets, empty for all frames
+    ERROR     server -> client  text of an error, e.g. an invalid filter
+
+The server gets the frames from a drop-oldest subscription and serves
+the clients from its own thread with non-blocking sockets, so clients
+never slow the acquisition down. A client whose unsent data exceeds
+maxClientBuffer loses the new frames, or is disconnected if
+disconnectSlow is set.
+'''
+import socket
+import select
+import struct
+import threading
+import errno
+import CANLog
+import CANFilter
+import CANController
+
+DEFAULT_PORT = 29536
+
+FRAMES = 1
+TRANSMIT = 2
+FILTER = 3
+ERROR = 4
+
+PACKET_HEADER = struct.Struct('<IB')   # length of type and body, type
+
+# Largest packet accepted from a client
+MAX_PACKET = 1 << 20
+
+# Longest time the server waits on the sockets before forwarding frames
+SELECT_TIMEOUT = 0.01
+
+
+def packet(kind, body):
+    return PACKET_HEADER.pack(len(body) + 1, kind) + body
+
+
+def check_frame(f, flags):
+    """Return why a frame received from a client cannot be sent as is,
+    None if it can
+    """
+    if flags & ~(CANLog.FLAG_XTD | CANLog.FLAG_RTR | CANLog.FLAG_TX):
+        return "unknown flags 0x%02x" % flags
+    if f.ndata > 8:
+        return "DLC %d greater than 8" % f.ndata
+    if f.xtd:
+        if f.msg_id > 0x1fffffff:
+            return "extended ID 0x%x greater than 0x1fffffff" % f.msg_id
+    elif f.msg_id > 0x7ff:
+        return "standard ID 0x%x greater than 0x7ff" % f.msg_id
+    return None
+
+
+class Client(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.predicate = None
+        self.inbuf = ''
+        self.outbuf = []
+        self.pending = 0     # bytes in outbuf
+        self.dropped = 0     # frames dropped because the client was too slow
+
+    def queue(self, data):
+        self.outbuf.append(data)
+        self.pending = self.pending + len(data)
+
+
+class FrameServer(threading.Thread):
+    def __init__(self, controller, host='127.0.0.1', port=DEFAULT_PORT,
+                 maxClientBuffer=4 << 20, disconnectSlow=False):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._controller = controller
+        self._maxClientBuffer = maxClientBuffer
+        self._disconnectSlow = disconnectSlow
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(5)
+        self.address = self._listener.getsockname()
+        self._clients = {}
+        self._subscription = None
+        self._abort = 0
+
+    def get_clients(self):
+        """Return [(address, bytes waiting, frames dropped)]"""
+        return [(c.address, c.pending, c.dropped) for c in self._clients.values()]
+
+    def stop(self):
+        self._abort = 1
+        self.join()
+
+    def run(self):
+        self._subscription = self._controller.Subscribe(policy=CANController.Subscription.DROP_OLDEST)
+        try:
+            while not self._abort:
+                self.__poll()
+                frames = self._subscription.get(0)
+                if frames:
+                    self.__forward(frames)
+        finally:
+            self._controller.Unsubscribe(self._subscription)
+            for c in self._clients.values():
+                c.sock.close()
+            self._clients = {}
+            self._listener.close()
+
+    def __poll(self):
+        clients = self._clients
+        writers = [c.sock for c in clients.values() if c.outbuf]
+        r, w, x = select.select([self._listener] + clients.keys(), writers, [], SELECT_TIMEOUT)
+        for sock in r:
+            if sock is self._listener:
+                sock, address = self._listener.accept()
+                sock.setblocking(0)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                clients[sock] = Client(sock, address)
+            elif sock in clients:
+                self.__read(clients[sock])
+        for sock in w:
+            if sock in clients:
+                self.__write(clients[sock])
+
+    def __close(self, c):
+        del self._clients[c.sock]
+        c.sock.close()
+
+    def __read(self, c):
+        try:
+            data = c.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.__close(c)
+            return
+        c.inbuf = c.inbuf + data
+        while len(c.inbuf) >= PACKET_HEADER.size:
+            length, kind = PACKET_HEADER.unpack_from(c.inbuf)
+            if length < 1 or length > MAX_PACKET:
+                self.__close(c)
+                return
+            end = PACKET_HEADER.size + length - 1
+            if len(c.inbuf) < end:
+                break
+            body = c.inbuf[PACKET_HEADER.size:end]
+            c.inbuf = c.inbuf[end:]
+            self.__handle(c, kind, body)
+
+    def __handle(self, c, kind, body):
+        if kind == TRANSMIT:
+            size = CANLog.RECORD.size
+            if len(body) % size:
+                c.queue(packet(ERROR, "TRANSMIT body is not a whole number of records"))
+                return
+            frames = []
+            for offset in range(0, len(body), size):
+                f, flags = CANLog.unpack_frame(body, offset)
+                error = check_frame(f, flags)
+                if error:
+                    # send none of the batch rather than part of it
+                    c.queue(packet(ERROR, "Record %d: %s" % (offset // size, error)))
+                    return
+                frames.append(f)
+            if frames:
+                self._controller.SendFrames([0] * len(frames), frames)
+        elif kind == FILTER:
+            try:
+                if body:
+                    c.predicate = CANFilter.compile_filter(body)
+                else:
+                    c.predicate = None
+            except CANFilter.FilterError, e:
+                c.queue(packet(ERROR, str(e)))
+        else:
+            c.queue(packet(ERROR, "Unknown packet type %d" % kind))
+
+    def __write(self, c):
+        data = ''.join(c.outbuf)
+        try:
+            n = c.sock.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__close(c)
+            return
+        data = data[n:]
+        if data:
+            c.outbuf = [data]
+        else:
+            c.outbuf = []
+        c.pending = len(data)
+
+    def __forward(self, frames):
+        shared = None
+        for c in self._clients.values():
+            if c.predicate:
+                selected = c.predicate(frames)
+                if not selected:
+                    continue
+                data = packet(FRAMES, CANLog.pack_frames(selected))
+            else:
+                selected = frames
+                if shared is None:
+                    # packed once for all the clients without filter
+                    shared = packet(FRAMES, CANLog.pack_frames(frames))
+                data = shared
+            if c.pending and c.pending + len(data) > self._maxClientBuffer:
+                if self._disconnectSlow:
+                    self.__close(c)
+                else:
+                    c.dropped = c.dropped + len(selected)
+                continue
+            c.queue(data)
+
+
+class FrameClient(object):
+    """Blocking client of a FrameServer"""
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.sock = socket.create_connection((host, port))
+        self._buf = ''
+
+    def close(self):
+        self.sock.close()
+
+    def set_filter(self, expression):
+        self.sock.sendall(packet(FILTER, expression or ''))
+
+    def send_frames(self, frames):
+        self.sock.sendall(packet(TRANSMIT, CANLog.pack_frames(frames)))
+
+    def recv_packet(self):
+        """Return the (type, body) of the next packet, None once the
+        server has closed the connection
+        """
+        while 1:
+            if len(self._buf) >= PACKET_HEADER.size:
+                length, kind = PACKET_HEADER.unpack_from(self._buf)
+                end = PACKET_HEADER.size + length - 1
+                if len(self._buf) >= end:
+                    body = self._buf[PACKET_HEADER.size:end]
+                    self._buf = self._buf[end:]
+                    return kind, body
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self._buf = self._buf + data
+
+    def recv_frames(self):
+        """Return the frames of the next FRAMES packet, raises IOError
+        with the text of an ERROR packet, None once disconnected
+        """
+        while 1:
+            p = self.recv_packet()
+            if p is None:
+                return None
+            kind, body = p
+            if kind == FRAMES:
+                size = CANLog.RECORD.size
+                return [CANLog.unpack_frame(body, offset)[0] for offset in range(0, len(body), size)]
+            if kind == ERROR:
+                raise IOError(body)
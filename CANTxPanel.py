@@ -22,6 +22,7 @@ class CANAnalyzerTxPanel(wx.Panel):
         self.canSignalRateBox.Add(wx.StaticText(self, label="Signal/s") , flag = wx.EXPAND)
         self.canSignalRate = wx.SpinCtrl(self, value="100")
         self.canSignalRate.SetRange(0, 2000)
+        self.canSignalRate.Bind(wx.EVT_SPINCTRL, self.OnRateChange)
         self.canSignalRateBox.Add(self.canSignalRate)
         
         self.vbox = wx.BoxSizer(wx.VERTICAL)
@@ -33,6 +34,8 @@ class CANAnalyzerTxPanel(wx.Panel):
         
         CANDatabase.candb.AddListener(self.OnCANDbUpdated)
         self.can = None
+        self.schedFrames = []
+        self.schedHandles = []
         
     def OnCANSignalSelect(self, event):
         pass
@@ -42,19 +45,38 @@ class CANAnalyzerTxPanel(wx.Panel):
         for sig in signals:
             self.canSignalList.Append(sig.get_name())
         
+    def OnRateChange(self, event):
+        if self.can:
+            rate = self.canSignalRate.GetValue()
+            if rate > 0 and self.schedHandles:
+                self.can.RescheduleFrames(self.schedHandles, 1000.0/rate)
+            else:
+                self.can.UnscheduleFrames(self.schedHandles)
+                self.schedHandles = []
+                self.ScheduleSelectedFrames()
+        
+    def ScheduleSelectedFrames(self):
+        # The spinner sets how many times per second each frame is sent
+        rate = self.canSignalRate.GetValue()
+        if rate > 0:
+            self.schedHandles = self.can.ScheduleFrames(self.schedFrames, 1000.0/rate)
+        
     def Start(self, can):
         self.can = can
         
-        schedFrames = [] 
+        self.schedFrames = [] 
         
         # Send selected CAN frames to scheduler
         for i in range(0,self.canSignalList.GetCount()):
             if self.canSignalList.IsChecked(i):
                 sig = CANDatabase.candb.FindSignalByName(self.canSignalList.GetString(i))
                 if sig != None:
-                    schedFrames.append(sig.to_canframe())
+                    self.schedFrames.append(sig.to_canframe())
                     
-        self.can.ScheduleFrames(schedFrames)                   
+        self.ScheduleSelectedFrames()
         
     def Stop(self):
+        if self.can:
+            self.can.UnscheduleFrames(self.schedHandles)
+        self.schedHandles = []
         self.can = None 
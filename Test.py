@@ -25,7 +25,7 @@ if __name__ == "__main__":
             try:
                 #sig = CANMessage.CANSignal("test", 0x300+(count%8), 0, 'f64', 'motorola', 56, 64, count/((count%8)+1))
                 sig = CANMessage.CANSignal("test", 0x300, 0, 'i32', 'intel', 4, 32, count)
-                canusb.transmit_frame(sig.to_canframe())
+                canusb.queue_frame(sig.to_canframe())
                 count = count + 1
             except lawicel_canusb.CANUSBError, e:
                 # re-raise error if it's not timeout
@@ -38,7 +38,7 @@ if __name__ == "__main__":
             if count >= 500:
                 duration = time.time()-startTime
                 rate = float(count) / duration
-                print "sent %d frames in %f s (%f frames/s)" % (count, duration, rate)
+                print "sent %d frames in %f s (%f frames/s, %d failed so far)" % (count, duration, rate, canusb.tx_failed)
                 startTime = time.time()
                 count = 0;
     finally:     
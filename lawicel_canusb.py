@@ -12,19 +12,45 @@ Hubert Hoegl, 2007-08-18, <hh at hhoegl.org>
 """
 
 import serial, array, time, sys, getopt, atexit
+from binascii import hexlify, unhexlify
 from collections import deque
 import CANMessage
 
 BAUD = 115200
 SERIAL_TIMEOUT = 1  # 1 msec
 
+# Default number of transmitted frames that may wait for their ack
+TX_WINDOW = 8
+# Number of per-frame transmit results kept until they are collected
+TX_RESULTS_LEN = 1024
+
+# Period of the dongle timestamp counter in msec
+TIMESTAMP_WRAP = 0xea60
+
 CR = 13
 BELL = 7
 
+# Longest message the dongle sends: extended frame with 8 data bytes and
+# timestamp (T + 8 id + 1 dlc + 16 data + 4 timestamp). Anything longer
+# without a CR is line noise.
+MAX_MESSAGE_LEN = 32
+
+# Kinds of command responses produced by SLCANParser
+RESP_OK = 0     # normal reply, possibly empty, terminated by CR
+RESP_ACK = 1    # 'z' or 'Z' acknowledging a transmitted frame
+RESP_ERROR = 2  # BELL
+
 sw_help = None
 sw_test = None
 
 
+# ASCII frame type -> (number of id digits, xtd, rtr)
+FRAME_TYPES = {'t': (3, 0, 0), 'T': (8, 1, 0), 'r': (3, 0, 1), 'R': (8, 1, 1)}
+
+# DLC digit -> number of data bytes
+DLC_DIGITS = dict([("%d" % n, n) for n in range(9)])
+
+
 class CANUSBError:
     def __init__(self, msg):
         self.msg = msg
@@ -33,8 +59,8 @@ class CANUSBError:
 
 
 class CANUSBFrame(CANMessage.CANFrame):
-    def __init__(self, msg_id=0, xtd=0, rtr=0, ndata=0, data=() ):
-        CANMessage.CANFrame.__init__(self, msg_id, xtd, rtr, ndata, data)    
+    def __init__(self, msg_id=0, xtd=0, rtr=0, ndata=0, data=(), timestamp=None):
+        CANMessage.CANFrame.__init__(self, msg_id, xtd, rtr, ndata, data, timestamp)    
     
     def to_ascii(self):
         """Convert Frame object to ASCII representation
@@ -42,20 +68,7 @@ class CANUSBFrame(CANMessage.CANFrame):
                tiiildd...
                Tiiiiiiiildd...
         """
-        s_list=[]
-        if self.xtd:
-            s_list.append('T')
-            s_list.append("%08x" % self.msg_id)
-        else:
-            s_list.append('t')
-            s_list.append("%03x" % self.msg_id)
-        
-        s_list.append(str(self.ndata))
-        
-        for i in range(0, self.ndata, 1):
-            s_list.append("%02x" % self.data[i])
-          
-        return "".join(s_list)
+        return encode_ascii(self)
 
     def from_ascii(self, s):
         """Convert from ASCII representation s to Frame object
@@ -63,37 +76,193 @@ class CANUSBFrame(CANMessage.CANFrame):
                tiiildd...
                Tiiiiiiiildd...
         """
-        if s[0] == 't':
-            # standard frame
-            self.msg_id = int(s[1:4], 16)
-            self.ndata = int(s[4])
-            s = s[5:]
-            d = []
-            for i in range(0, len(s), 2):
-                d.append(int(s[i:i+2],16))
-            self.data = tuple(d)
-            self.rtr = 0
-            self.xtd = 0
-
-        elif s[0] == 'T':
-            # extended frame
-            self.msg_id = int(s[1:9], 16)
-            self.ndata = int(s[9])
-            s = s[10:]
-            d = []
-            for i in range(0, len(s), 2):
-                d.append(int(s[i:i+2],16))
-            self.data = tuple(d)
-            self.rtr = 0
-            self.xtd = 1
+        self.msg_id, self.xtd, self.rtr, self.ndata, self.data, hwts = decode_ascii(s)
+
+
+def encode_ascii(f):
+    """Encode any CAN frame object to its ASCII representation, without
+    the trailing CR.
+    """
+    ndata = f.get_ndata()
+    if f.get_xtd():
+        fmt = "T%08x%d"
+    else:
+        fmt = "t%03x%d"
+    if f.get_rtr():
+        return fmt.replace('t', 'r').replace('T', 'R') % (f.get_msg_id(), ndata)
+    return (fmt % (f.get_msg_id(), ndata)) + hexlify(bytearray(f.get_data()[:ndata]))
+
+
+def decode_ascii(s):
+    """Decode an ASCII frame (t, T, r or R message without the trailing
+    CR). Returns a (msg_id, xtd, rtr, ndata, data, hwts) tuple where hwts
+    is the dongle timestamp in msec, or None if timestamps are off.
+    """
+    n_id, xtd, rtr = FRAME_TYPES[s[0]]
+    ndata = DLC_DIGITS[s[n_id+1]]
+    start = n_id + 2
+    if rtr or not ndata:
+        data = ()
+    else:
+        data = tuple(bytearray(unhexlify(s[start:start+2*ndata])))
+        start = start + 2*ndata
+    if len(s) > start:
+        hwts = int(s[start:start+4], 16)
+    else:
+        hwts = None
+    return int(s[1:n_id+1], 16), xtd, rtr, ndata, data, hwts
+
+
+def frames_from_ascii(strings, clock=None):
+    """Decode a batch of ASCII frames into a list of CANUSBFrame objects.
+    With a TimestampClock the frames are stamped with the unwrapped
+    dongle timestamp. Otherwise they all get the host time of the batch.
+    """
+    now = time.time()
+    frames = []
+    append = frames.append
+    if clock:
+        clock.sync(now)
+        unwrap = clock.unwrap
+        for s in strings:
+            msg_id, xtd, rtr, ndata, data, hwts = decode_ascii(s)
+            if hwts is None:
+                append(CANUSBFrame(msg_id, xtd, rtr, ndata, data, now))
+            else:
+                append(CANUSBFrame(msg_id, xtd, rtr, ndata, data, unwrap(hwts)))
+    else:
+        for s in strings:
+            msg_id, xtd, rtr, ndata, data, hwts = decode_ascii(s)
+            append(CANUSBFrame(msg_id, xtd, rtr, ndata, data, now))
+    return frames
+
+
+class TimestampClock(object):
+    """Converts the dongle timestamps to host time in seconds.
+
+    The timestamp counter counts msec from 0 to 0xea5f and wraps around
+    every minute. It is unwrapped into a monotonic msec count (ticks),
+    which is anchored to the host time the first frame was read at.
+    Wraparounds that happened while no frame was received are counted
+    from the host time elapsed between two batches.
+    """
+    def __init__(self):
+        self.ticks = None
+        self._last = 0
+        self._anchor = 0.0
+        self._host = 0.0
+        self._gap = 0.0
+
+    def sync(self, now):
+        """Called once per batch of frames with the host time it was read"""
+        self._gap = now - self._host
+        self._host = now
+
+    def unwrap(self, ts):
+        if self.ticks is None:
+            self.ticks = ts
+            self._anchor = self._host - ts / 1000.0
+        else:
+            delta = ts - self._last
+            if delta < 0:
+                delta = delta + TIMESTAMP_WRAP
+            if self._gap > TIMESTAMP_WRAP / 2000.0:
+                # long silence, the counter may have wrapped several times
+                wraps = int((self._gap * 1000.0 - delta) / TIMESTAMP_WRAP + 0.5)
+                if wraps > 0:
+                    delta = delta + wraps * TIMESTAMP_WRAP
+            self.ticks = self.ticks + delta
+        self._gap = 0.0
+        self._last = ts
+        return self._anchor + self.ticks / 1000.0
+
+
+class SLCANParser(object):
+    """Incremental parser for the ASCII stream sent by the CANUSB dongle.
+
+    Data read from the serial port is fed in chunks of any size. Complete
+    received frames ('t', 'T', 'r' and 'R' messages, without the trailing
+    CR) are appended to frames. Acks, BELL errors and command replies are
+    appended to responses as (kind, text) tuples, in the order the dongle
+    sent them. A message cut at the end of a chunk is carried over and
+    completed by the next call to feed().
+    """
+    def __init__(self):
+        self._buf = ''
+        self.frames = deque()
+        self.responses = deque()
+        self.dropped = 0  # malformed messages thrown away
+
+    def feed(self, data):
+        if self._buf:
+            buf = self._buf + data
+        else:
+            buf = data
+        frames = self.frames
+        responses = self.responses
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            c = buf[pos]
+            if c == '\x07':
+                # BELL is a complete response on its own, no CR follows
+                responses.append((RESP_ERROR, ''))
+                pos = pos + 1
+                continue
+
+            cr = buf.find('\r', pos)
+            if cr < 0:
+                # incomplete message, wait for more data
+                break
+
+            if c in 'tTrR':
+                if self.__frame_complete(buf, pos, cr):
+                    frames.append(buf[pos:cr])
+                else:
+                    self.dropped = self.dropped + 1
+            elif c in 'zZ' and cr == pos + 1:
+                responses.append((RESP_ACK, c))
+            else:
+                responses.append((RESP_OK, buf[pos:cr]))
+            pos = cr + 1
+
+        self._buf = buf[pos:]
+        if len(self._buf) > MAX_MESSAGE_LEN:
+            self._buf = ''
+            self.dropped = self.dropped + 1
+
+    def __frame_complete(self, buf, pos, cr):
+        """Check the length of the frame buf[pos:cr] against its DLC.
+        A 4 digit timestamp may follow the payload.
+        """
+        if buf[pos] in 'tr':
+            header = 5
         else:
-            pass # should never happen
+            header = 10
+        if cr - pos < header:
+            return False
+        dlc = buf[pos + header - 1]
+        if dlc < '0' or dlc > '8':
+            return False
+        n = header
+        if buf[pos] in 'tT':
+            n = n + 2 * (ord(dlc) - 48)
+        return cr - pos == n or cr - pos == n + 4
 
 
 class CanUSB(object):
     def __init__(self, device, baud):
         self.ser = serial.Serial(device, baud, timeout=SERIAL_TIMEOUT)
-        self.rxfifo = deque()
+        self._timeout = SERIAL_TIMEOUT
+        self._parser = SLCANParser()
+        self.rxfifo = self._parser.frames
+        self.tx_window = TX_WINDOW
+        self._tx_pending = deque()
+        self._tx_results = deque(maxlen=TX_RESULTS_LEN)
+        self._clock = None
+        self.bytes_read = 0
+        self.tx_ok = 0
+        self.tx_failed = 0
 
     def __del__(self):
         self.ser.close()
@@ -110,7 +279,7 @@ class CanUSB(object):
         Frame object which is returned. Return None if rxfifo is empty.
         """
         if len(self.rxfifo) > 0:
-            fstr = self.rxfifo.pop()
+            fstr = self.rxfifo.popleft()
             f = CANUSBFrame()
             f.from_ascii(fstr)
             del fstr
@@ -118,13 +287,24 @@ class CanUSB(object):
         else:
             return None
 
-    def poll(self):
+    def get_rx_frames(self):
+        """Get all frames waiting in the rxfifo as a list of Frame objects.
+        Return an empty list if rxfifo is empty.
+        """
+        if not self.rxfifo:
+            return []
+        frames = frames_from_ascii(self.rxfifo, self._clock)
+        self.rxfifo.clear()
+        return frames
+
+    def poll(self, timeout=SERIAL_TIMEOUT):
         """Check for incoming data packets. Note that also all other
         commands which write to the CANUSB dongle check for incoming
         data.
+        timeout -- Seconds to wait for data if none is waiting
         """
-        cmd = None
-        return self.__send_command(cmd)
+        self.__read(timeout)
+        return []
 
     def set_bitrate(self, bitrate):
         if bitrate == 10000:
@@ -182,8 +362,84 @@ class CanUSB(object):
         return self.__send_command('T' + packet)
     
     def transmit_frame(self, f):
-        usbf = CANUSBFrame(msg_id=f.get_msg_id(), xtd=f.get_xtd(), rtr=f.get_rtr(), ndata=f.get_ndata(), data=f.get_data())
-        return self.__send_command(usbf.to_ascii())
+        """Transmit frame f and wait for the dongle to acknowledge it.
+        Returns z[CR] or Z[CR], raises an error on BELL.
+        """
+        self.queue_frame(f)
+        self.flush_tx()
+        f, ok = self._tx_results.pop()
+        if not ok:
+            raise CANUSBError('ser.read returned BELL char (ERROR)')
+        if f.get_xtd():
+            return [ord('Z')]
+        return [ord('z')]
+
+    def queue_frame(self, f):
+        """Transmit frame f without waiting for its ack. Up to tx_window
+        frames can be in flight, this only blocks when the window is full.
+        The outcome of each frame is reported by get_tx_results().
+        """
+        self.__wait_acks(self.tx_window - 1)
+        self.ser.write(encode_ascii(f)+chr(CR))
+        self._tx_pending.append(f)
+
+    def queue_frames(self, frames):
+        """Transmit a list of frames without waiting for their acks. The
+        frames are written in chunks of at most tx_window frames, one
+        serial write per chunk, each once the frames transmitted earlier
+        have been acknowledged enough for it to fit in the tx window. If
+        waiting times out, the frames not written yet are reported as
+        failed too, so every frame gets exactly one result.
+        """
+        cr = chr(CR)
+        window = self.tx_window
+        for i in range(0, len(frames), window):
+            chunk = frames[i:i+window]
+            try:
+                self.__wait_acks(window - len(chunk))
+            except CANUSBError:
+                for f in frames[i:]:
+                    self.tx_failed = self.tx_failed + 1
+                    self._tx_results.append((f, False))
+                raise
+            self.ser.write(cr.join([encode_ascii(f) for f in chunk]) + cr)
+            self._tx_pending.extend(chunk)
+
+    def transmit_frames(self, frames):
+        """Transmit a list of frames and wait for all their acks. The
+        frames are written in batches of TX_RESULTS_LEN frames, one serial
+        write per batch. Returns a list with one boolean per frame, False
+        if the dongle refused the frame.
+        """
+        results = []
+        for i in range(0, len(frames), TX_RESULTS_LEN):
+            batch = frames[i:i+TX_RESULTS_LEN]
+            self.queue_frames(batch)
+            self.flush_tx()
+            # taken out so that get_tx_results() does not report them again
+            oks = [self._tx_results.pop()[1] for f in batch]
+            oks.reverse()
+            results.extend(oks)
+        return results
+
+    def flush_tx(self):
+        """Wait until all queued frames have been acknowledged"""
+        self.__wait_acks(0)
+
+    def get_parser_dropped(self):
+        """Number of malformed messages thrown away by the parser"""
+        return self._parser.dropped
+
+    def get_tx_pending(self):
+        return len(self._tx_pending)
+
+    def get_tx_results(self):
+        """Return the outcome of the frames transmitted since the last
+        call as a list of (frame, ok) tuples, in transmit order.
+        """
+        results = list(self._tx_results)
+        self._tx_results.clear()
+        return results
 
     def get_status_flags(self):
         """Get the SJA1000 status flags
@@ -227,71 +483,152 @@ class CanUSB(object):
         after 60.000 msec (= 1 minute). This command is only active if
         the CAN channel is closed.
         
+        When on, received frames are stamped with the unwrapped dongle
+        time instead of the host time they were read at.
+
         onoff - a character '1' (on) or '0' (off)
         """
-        return self.__send_command("Z"+onoff)
+        r = self.__send_command("Z"+onoff)
+        if onoff == '1':
+            self._clock = TimestampClock()
+        else:
+            self._clock = None
+        return r
 
     def __send_command(self, cmd):
         """Send a command to the CANUSB dongle. Returns the command
         response as a list of integer values or an empty list if no
         command response.
-        cmd -- A command string without the trailing [CR]
+        cmd -- A command string without the trailing [CR]. If None, only
+               read the incoming data.
         """
-        R = []
-
-        if cmd:
-            self.ser.write(cmd+chr(CR))
-
-        while 1:
-            d = self.ser.read(size=1)
-            if not d:
+        if not cmd:
+            self.__read()
+            return []
+
+        # The dongle answers in order, so collect the acks of the frames
+        # still in flight first. Responses left over from earlier polls or
+        # from empty_queue() can't belong to this command.
+        self.__wait_acks(0)
+        responses = self._parser.responses
+        responses.clear()
+        self.ser.write(cmd+chr(CR))
+
+        while not responses:
+            self.__read()
+        kind, text = responses.popleft()
+        if kind == RESP_ERROR:
+            # canusb returned an error
+            raise CANUSBError('ser.read returned BELL char (ERROR)')
+        return stol(text)
+
+    def __read(self, timeout=SERIAL_TIMEOUT):
+        """Read everything waiting in the serial port buffer in a single
+        call and feed it to the parser. Blocks for at most timeout seconds
+        if nothing is waiting.
+        """
+        n = self.ser.inWaiting()
+        if n:
+            data = self.ser.read(n)
+        else:
+            if timeout != self._timeout:
+                # reconfigures the port, only do it when needed
+                self.ser.timeout = timeout
+                self._timeout = timeout
+            data = self.ser.read(1)
+            if not data:
                 # timeout
                 raise CANUSBError('ser.read returned None (timeout)')
-            if d in ('t', 'T'):
-                fstr = self.__parse_incoming_frame(d)
-                self.rxfifo.appendleft(fstr)
-                return R
-                #continue
-            if ord(d) == CR:
-                # normal end of command response
-                break
-            if ord(d) == BELL and len(R) == 0:
-                # canusb returned an error
-                raise CANUSBError('ser.read returned BELL char (ERROR)')
-                pass
+            # grab whatever arrived with the first byte as well
+            n = self.ser.inWaiting()
+            if n:
+                data = data + self.ser.read(n)
+        self.bytes_read = self.bytes_read + len(data)
+        self._parser.feed(data)
+        if self._tx_pending:
+            self.__match_acks()
+        return len(data)
+
+    def __match_acks(self):
+        """Match the responses received so far with the frames in flight"""
+        pending = self._tx_pending
+        responses = self._parser.responses
+        while pending and responses:
+            kind, text = responses.popleft()
+            f = pending.popleft()
+            if kind == RESP_ACK:
+                self.tx_ok = self.tx_ok + 1
+                self._tx_results.append((f, True))
             else:
-                R.append( ord(d) )
-        return R
+                self.tx_failed = self.tx_failed + 1
+                self._tx_results.append((f, False))
 
-    def __parse_incoming_frame(self, firstchar):
-        """An incoming CAN frame is immediately sent over RS232 to the PC
-        with the same formatting as for transmit packages. Every char
-        returned from RS232 must be checked to be 't' or 'T' (see
-        __send_command() ) . If this is the case a CAN packet is returned.
-
-        firstchar -- either 't' or 'T'
+    def __wait_acks(self, n):
+        """Read until at most n transmitted frames wait for their ack. On
+        timeout the frames still in flight are reported as failed.
         """
-        if firstchar == 't':
-            # simple frame
-            n_id = 3
-            r_packet = 't'
-        if firstchar == 'T':
-            # extended frame
-            n_id = 8
-            r_packet = 'T'
-        s = self.ser.read(size=n_id + 1)  # id + data length
-        # To Do: raise error if read does not work
-        r_packet = r_packet + s
-        n_data = ord(s[n_id])-ord('0')
-        s = self.ser.read(size=n_data*2) # each byte has two chars
-        # To Do: raise error if read does not work
-        r_packet = r_packet + s
-        s = self.ser.read(size=1) # final CR of 't/T' packet
-        # To Do: raise error if read does not work
-        return r_packet
-
-
-def opencan(device, bitrate):
+        while len(self._tx_pending) > n:
+            try:
+                self.__read()
+            except CANUSBError:
+                while self._tx_pending:
+                    self.tx_failed = self.tx_failed + 1
+                    self._tx_results.append((self._tx_pending.popleft(), False))
+                raise
+
+
+def acceptance_filter(std_ids=(), ext_ids=()):
+    """Compute the SJA1000 acceptance code and mask that let the given
+    standard and extended IDs through. Returns them as (code, mask) hex
+    strings for set_acc_code() and set_acc_mask().
+
+    The CANUSB runs the SJA1000 in dual filter mode. Each of the two
+    filters compares 16 bits: the 11 bit ID (then RTR and data bits, which
+    are left as don't care) for standard frames, and the 16 most
+    significant bits of the 29 bit ID for extended frames. The IDs are
+    split in two groups, one per filter, so that as few unwanted IDs as
+    possible pass. Frames that still get through must be filtered in
+    software.
+    """
+    # (16 bit value compared by a filter, bits that matter)
+    images = [((i & 0x7ff) << 5, 0xffe0) for i in std_ids] + \
+             [((i >> 13) & 0xffff, 0xffff) for i in ext_ids]
+    if not images:
+        return "00000000", "ffffffff"
+    images.sort()
+
+    # Masks of all the ways to put images[:k] in filter 1 and images[k:]
+    # in filter 2. A filter with mask m accepts 2**(bits set in m) values.
+    n = len(images)
+    head = [0] * (n + 1)
+    for k in range(1, n + 1):
+        v, care = images[k-1]
+        head[k] = head[k-1] | (v ^ images[0][0]) | (~care & 0xffff)
+    tail = [0] * (n + 1)
+    for k in range(n - 1, -1, -1):
+        v, care = images[k]
+        tail[k] = tail[k+1] | (v ^ images[n-1][0]) | (~care & 0xffff)
+
+    best = None
+    for k in range(1, n + 1):
+        if k == n:
+            # a single group, both filters get the same setting
+            mask1, mask2, v2 = head[n], head[n], images[0][0]
+        else:
+            mask1, mask2, v2 = head[k], tail[k], images[n-1][0]
+        cost = (1 << bin(mask1).count('1')) + (1 << bin(mask2).count('1'))
+        if best is None or cost < best[0]:
+            best = (cost, images[0][0] & ~mask1, mask1, v2 & ~mask2, mask2)
+    cost, code1, mask1, code2, mask2 = best
+
+    # AC3/AM3 bits 3..0 also hold the data bits compared by filter 1 for
+    # standard frames, so they are always don't care.
+    code = (code1 << 16) | (code2 & 0xfff0)
+    mask = (mask1 << 16) | (mask2 & 0xfff0) | 0xf
+    return "%08x" % code, "%08x" % mask
+
+
+def opencan(device, bitrate, timestamps=False, acc_code=None, acc_mask=None):
     c = CanUSB(device, BAUD)
     
     # Close channel in case it was left open
@@ -304,6 +641,14 @@ def opencan(device, bitrate):
 
     c.set_bitrate(bitrate)
 
+    if timestamps:
+        c.timestamp('1')
+
+    if acc_code:
+        c.set_acc_code(acc_code)
+    if acc_mask:
+        c.set_acc_mask(acc_mask)
+
     # print "set_btr0btr1"
     # c.set_btr0btr1("34", "ce")
 
@@ -0,0 +1,309 @@
+"""Simulated CAN-USB dongle
+
+Serves the ASCII protocol of the Lawicel CAN-USB on a Linux
+pseudo-terminal so that lawicel_canusb and CANController can be tested
+and benchmarked without the hardware. The device answers the O, C, S, s,
+F, V, N, M, m and Z commands, acknowledges transmitted frames and
+generates configurable receive traffic, at rates well above what a real
+bus allows.
+
+Usage: python lawicel_canusb_sim.py [options], see usage().
+"""
+
+import os, sys, tty, time, random, select, getopt, threading, errno, fcntl
+
+CR = '\r'
+BELL = '\x07'
+
+# Bits of the status flags returned by the F command
+STATUS_RX_FIFO_FULL = 0x01
+STATUS_ERROR_WARNING = 0x04
+STATUS_DATA_OVERRUN = 0x08
+STATUS_BUS_ERROR = 0x80
+
+TIMESTAMP_WRAP = 0xea60
+
+
+class VirtualCanUSB(threading.Thread):
+    def __init__(self, ids=((0x100, 0, 1),), rate=1000.0, burst=1, dlc=8,
+                 error_interval=0.0, fifo_size=65536):
+        """
+        ids -- Sequence of (msg_id, xtd, weight) tuples, the generated
+               frames use these IDs in proportion to their weight
+        rate -- Average number of generated frames per second
+        burst -- Number of frames sent back to back in each burst
+        dlc -- Number of data bytes of the generated frames
+        error_interval -- Raise the bus error flags every error_interval
+                          seconds, 0 to never raise them
+        fifo_size -- Bytes buffered for the host before frames are lost
+                     and the overrun flags are raised
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._master, self._slave = os.openpty()
+        # the protocol is binary-safe only without echo and CR translation
+        tty.setraw(self._slave)
+        fcntl.fcntl(self._master, fcntl.F_SETFL, fcntl.fcntl(self._master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.device = os.ttyname(self._slave)
+
+        self._ids = []
+        for msg_id, xtd, weight in ids:
+            self._ids.extend([(msg_id, xtd)] * weight)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.dlc = dlc
+        self.error_interval = error_interval
+        self.fifo_size = fifo_size
+
+        self._abort = 0
+        self._in = ''
+        self._out = ''
+        self._bitrate_set = False
+        self._open = False
+        self._timestamps = False
+        self._acc_code = 0
+        self._acc_mask = 0xffffffff
+        self._status = 0
+        self._start = time.time()
+
+        self.rx_generated = 0  # frames sent to the host
+        self.rx_lost = 0       # frames lost because the host was too slow
+        self.tx_acked = 0      # frames transmitted by the host
+
+    def stop(self):
+        self._abort = 1
+        self.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def run(self):
+        sent = 0
+        lastErrors = time.time()
+        while not self._abort:
+            if self._out:
+                r, w, x = select.select([self._master], [self._master], [], 0.001)
+            else:
+                r, w, x = select.select([self._master], [], [], 0.001)
+            if r:
+                self.__handle_input(os.read(self._master, 4096))
+            if self._out and w:
+                self.__write()
+
+            now = time.time()
+            if self._open and self.rate > 0:
+                # generate whole bursts of frames as they become due
+                due = int((now - self._opened) * self.rate) - sent
+                if due >= self.burst:
+                    n = due - due % self.burst
+                    self.__generate(n, now)
+                    sent = sent + n
+            else:
+                sent = 0
+            if self.error_interval > 0 and now - lastErrors >= self.error_interval:
+                lastErrors = now
+                self._status = self._status | STATUS_BUS_ERROR | STATUS_ERROR_WARNING
+
+    def __write(self):
+        try:
+            n = os.write(self._master, self._out)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return
+        self._out = self._out[n:]
+
+    def __handle_input(self, data):
+        self._in = self._in + data
+        while 1:
+            cr = self._in.find(CR)
+            if cr < 0:
+                break
+            cmd = self._in[:cr]
+            self._in = self._in[cr+1:]
+            self._out = self._out + self.__command(cmd)
+
+    def __command(self, cmd):
+        """Execute one command and return the response"""
+        c = cmd[:1]
+        if c == '':
+            return CR
+        if c in 'tTrR':
+            if not self._open or not self.__frame_valid(cmd):
+                return BELL
+            self.tx_acked = self.tx_acked + 1
+            if c in 'tr':
+                return 'z' + CR
+            return 'Z' + CR
+        if c == 'O':
+            if self._open or not self._bitrate_set:
+                return BELL
+            self._open = True
+            self._opened = time.time()
+            return CR
+        if c == 'C':
+            if not self._open:
+                return BELL
+            self._open = False
+            return CR
+        if c == 'F':
+            if not self._open:
+                return BELL
+            # reading the flags clears them, like the SJA1000 interrupt register
+            status = self._status
+            self._status = 0
+            return 'F%02X' % status + CR
+        if c == 'V':
+            return 'V1011' + CR
+        if c == 'N':
+            return 'NSIM0' + CR
+        # the remaining commands only work while the channel is closed
+        if self._open:
+            return BELL
+        if (c == 'S' and cmd[1:] in '012345678' and len(cmd) == 2) or \
+           (c == 's' and len(cmd) == 5):
+            self._bitrate_set = True
+            return CR
+        if c in 'Mm' and len(cmd) == 9:
+            try:
+                value = int(cmd[1:], 16)
+            except ValueError:
+                return BELL
+            if c == 'M':
+                self._acc_code = value
+            else:
+                self._acc_mask = value
+            return CR
+        if c == 'Z' and cmd[1:] in ('0', '1'):
+            self._timestamps = cmd[1:] == '1'
+            return CR
+        return BELL
+
+    def __frame_valid(self, cmd):
+        if cmd[0] in 'tr':
+            header = 5
+        else:
+            header = 10
+        if len(cmd) < header or not cmd[header-1].isdigit() or int(cmd[header-1]) > 8:
+            return False
+        if cmd[0] in 'rR':
+            return len(cmd) == header
+        return len(cmd) == header + 2 * int(cmd[header-1])
+
+    def __accepts(self, msg_id, xtd, data0):
+        """SJA1000 acceptance filter in dual filter mode"""
+        code = self._acc_code
+        mask = self._acc_mask
+        if xtd:
+            value = (msg_id >> 13) & 0xffff
+            f1 = value << 16
+            f2 = value
+            care1 = 0xffff0000
+            care2 = 0x0000ffff
+        else:
+            value = (msg_id & 0x7ff) << 5
+            f1 = (value << 16) | ((data0 >> 4) << 16) | (data0 & 0xf)
+            f2 = value
+            care1 = 0xffff000f
+            care2 = 0x0000fff0
+        return ((f1 ^ code) & ~mask & care1) == 0 or ((f2 ^ code) & ~mask & care2) == 0
+
+    def __generate(self, n, now):
+        ids = self._ids
+        choice = random.choice
+        dlc = self.dlc
+        if self._timestamps:
+            ts = '%04X' % (int((now - self._start) * 1000) % TIMESTAMP_WRAP)
+        else:
+            ts = ''
+        frames = []
+        for i in range(n):
+            msg_id, xtd = choice(ids)
+            counter = self.rx_generated + i
+            data = '%016X' % ((counter * 0x0101010101010101) & 0xffffffffffffffff)
+            if not self.__accepts(msg_id, xtd, counter & 0xff):
+                continue
+            if xtd:
+                frames.append('T%08X%d%s%s\r' % (msg_id, dlc, data[:2*dlc], ts))
+            else:
+                frames.append('t%03X%d%s%s\r' % (msg_id, dlc, data[:2*dlc], ts))
+        self.rx_generated = self.rx_generated + n
+
+        if len(self._out) > self.fifo_size:
+            # the host doesn't read fast enough, the dongle fifo overflows
+            self.rx_lost = self.rx_lost + len(frames)
+            self._status = self._status | STATUS_RX_FIFO_FULL | STATUS_DATA_OVERRUN
+            return
+        self._out = self._out + ''.join(frames)
+
+
+def usage():
+    print """%s [options]
+-h, --help         Print help
+--rate=n           Generate n frames/s (default 1000)
+--burst=n          Send frames in bursts of n (default 1)
+--ids=id,id,...    IDs of the generated frames, in hex (default 100)
+--xtd              Generate extended frames
+--errors=s         Raise the bus error flags every s seconds
+--bench=s          Run CANController against the device for s seconds
+                   and print the receive rate
+""" % (sys.argv[0],)
+
+
+def bench(device, duration):
+    import CANController
+    c = CANController.CANUSBController(device, 500000)
+    counts = []
+    c.Start(counts.append)
+    try:
+        time.sleep(duration)
+    finally:
+        c.Stop()
+    n = c.GetTotalFrameCount()
+    print "received %d frames in %f s (%f frames/s)" % (n, duration, n / duration)
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "rate=", "burst=", "ids=", "xtd", "errors=", "bench="])
+    except getopt.error, why:
+        print why
+        sys.exit(1)
+
+    rate = 1000.0
+    burst = 1
+    ids = [0x100]
+    xtd = 0
+    errors = 0.0
+    duration = 0.0
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--rate':
+            rate = float(a)
+        elif o == '--burst':
+            burst = int(a)
+        elif o == '--ids':
+            ids = [int(i, 16) for i in a.split(',')]
+        elif o == '--xtd':
+            xtd = 1
+        elif o == '--errors':
+            errors = float(a)
+        elif o == '--bench':
+            duration = float(a)
+
+    sim = VirtualCanUSB([(i, xtd, 1) for i in ids], rate, burst, error_interval=errors)
+    sim.start()
+    print "Virtual CANUSB on %s" % sim.device
+    try:
+        if duration > 0:
+            bench(sim.device, duration)
+            print "generated %d frames, %d lost, %d transmitted by the host" % \
+                  (sim.rx_generated, sim.rx_lost, sim.tx_acked)
+        else:
+            while 1:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()